@@ -3,14 +3,380 @@ E-ラーニングシステム用データベース管理モジュール
 ユーザー管理・回答履歴・得点保存
 """
 
+import atexit
+import os
+import queue
 import sqlite3
 import hashlib
+import hmac
 import json
-import yaml
-from datetime import datetime, timedelta
+import re
+import secrets
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Tuple
 
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
+
+from file_cache import cached_read, parse_yaml
+
+# orjsonが利用できればCで高速にJSONを変換（なければ標準のjson）
+try:
+    import orjson
+    
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+    
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+    
+    _json_loads = json.loads
+
+
+def _now() -> str:
+    """現在時刻をSQLiteに保存する文字列（YYYY-MM-DD HH:MM:SS）で返す"""
+    return datetime.now().isoformat(sep=' ', timespec='seconds')
+
+
+def _quiz_result_rows(user_id: int, course_id: int,
+                      results: List[Dict[str, Any]]) -> List[Tuple]:
+    """回答結果のリストを INSERT_QUIZ_RESULT のパラメータ行に変換"""
+    return [
+        (user_id, course_id, r['question_id'],
+         _json_dumps(r['selected_answers']),
+         r['is_correct'], r['score_earned'])
+        for r in results
+    ]
+
+
+# パスワードハッシュ（Argon2id）
+_PASSWORD_HASHER = PasswordHasher()
+
+# SSOユーザーのパスワードハッシュ（どのパスワードとも一致しない値）
+_SSO_PASSWORD_HASH = "!"
+
+# 旧形式（ソルトなしSHA-256の16進64文字）のハッシュ
+_LEGACY_SHA256_HASH = re.compile(r'[0-9a-f]{64}')
+
+# 照合に失敗した (ハッシュ, パスワードのHMAC-SHA256) の組を記憶し、
+# 同じ誤パスワードの再試行でArgon2の計算を繰り返さない
+# （鍵はプロセスごとに生成し、メモリ上の値から誤パスワードを総当たりで復元させない）
+_FAILED_VERIFY_CACHE: "OrderedDict[Tuple[str, bytes], bool]" = OrderedDict()
+_FAILED_VERIFY_CACHE_SIZE = 1024
+_FAILED_VERIFY_LOCK = threading.Lock()
+_FAILED_VERIFY_KEY = secrets.token_bytes(32)
+
+# ===== SQL（一度だけ定義し、接続のステートメントキャッシュで再利用） =====
+
+# 接続ごとにキャッシュするプリペアドステートメント数（既定値は128）
+_CACHED_STATEMENTS = 256
+
+# バックグラウンド書き込み（この件数またはこの秒数の到着分を1トランザクションにまとめる）
+_WRITE_BATCH = 100
+_WRITE_BATCH_WINDOW = 0.05
+
+# ロック競合時に待つ最大時間（ミリ秒）
+_BUSY_TIMEOUT_MS = 30000
+
+# 必要なSQLiteのバージョン（STRICTテーブルは3.37、RETURNINGは3.35以降）
+_MIN_SQLITE_VERSION = (3, 37, 0)
+
+# 定期メンテナンス（PRAGMA optimize・WALチェックポイント）の実行間隔（秒）
+_MAINTENANCE_INTERVAL = 900
+
+# ユーザー管理
+INSERT_USER = '''
+    INSERT INTO users (username, password_hash, email, full_name, role)
+    VALUES (?, ?, ?, ?, ?)
+'''
+# SSOユーザーを登録（既存なら氏名・メールと最終ログインを更新）してIDとステータスを返す
+UPSERT_SSO_USER = '''
+    INSERT INTO users (username, password_hash, email, full_name, role, last_login)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE 
+    SET email = excluded.email, full_name = excluded.full_name,
+        last_login = excluded.last_login
+    RETURNING user_id, status
+'''
+# 有効かつロック中でないユーザーの失敗回数を加算して照合情報を返す
+# （期限切れのロックはここで解除し、失敗回数を1から数え直す）
+CLAIM_LOGIN_ATTEMPT = '''
+    UPDATE users 
+    SET failed_login_count = CASE WHEN locked_until IS NULL
+                                  THEN failed_login_count + 1 ELSE 1 END,
+        locked_until = NULL
+    WHERE username = ? AND status = 'active'
+      AND (locked_until IS NULL OR locked_until < ?)
+    RETURNING user_id, password_hash, failed_login_count
+'''
+SELECT_USER_AUTH = '''
+    SELECT user_id, status, locked_until
+    FROM users WHERE username = ?
+'''
+RESET_USER_LOCK = '''
+    UPDATE users SET failed_login_count = 0, locked_until = NULL
+    WHERE user_id = ?
+'''
+LOCK_USER = '''
+    UPDATE users SET locked_until = ? WHERE user_id = ?
+'''
+# 旧形式（ローカル時刻のISO文字列）の locked_until をUNIX時刻（秒）へ移行
+MIGRATE_LOCKED_UNTIL_EPOCH = '''
+    UPDATE users 
+    SET locked_until = CAST(strftime('%s', locked_until, 'utc') AS INTEGER)
+    WHERE typeof(locked_until) = 'text' AND locked_until LIKE '____-__-__%'
+'''
+UPDATE_LOGIN_SUCCESS = '''
+    UPDATE users 
+    SET last_login = ?, failed_login_count = 0, locked_until = NULL
+    WHERE user_id = ?
+'''
+UPDATE_PASSWORD_HASH = '''
+    UPDATE users SET password_hash = ? WHERE user_id = ?
+'''
+SELECT_USER_INFO = '''
+    SELECT user_id, username, email, full_name, role, status, created_at, last_login
+    FROM users WHERE user_id = ?
+'''
+UPDATE_USER_STATUS = '''
+    UPDATE users SET status = ? WHERE user_id = ?
+'''
+SELECT_ALL_USERS = '''
+    SELECT user_id, username, email, full_name, role, status, 
+           failed_login_count, last_login, created_at
+    FROM users
+    ORDER BY created_at DESC
+'''
+
+# コース管理
+INSERT_COURSE = '''
+    INSERT INTO courses 
+    (course_name, description, pdf_path, pptx_path, 
+     access_start_date, access_end_date, quiz_time_limit_seconds, passing_score_percent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SELECT_COURSES = '''
+    SELECT course_id, course_name, description,
+           quiz_time_limit_seconds AS quiz_time_limit,
+           passing_score_percent AS passing_score, created_at
+    FROM courses ORDER BY created_at DESC
+'''
+
+# 採点・結果管理
+INSERT_QUIZ_RESULT = '''
+    INSERT INTO quiz_results 
+    (user_id, course_id, question_id, selected_answers, is_correct, score_earned)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SAVE_COURSE_SCORE = '''
+    INSERT INTO course_scores
+    (user_id, course_id, total_score, max_score, score_percent, passed, completed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, course_id) DO UPDATE SET
+        total_score = excluded.total_score,
+        max_score = excluded.max_score,
+        score_percent = excluded.score_percent,
+        passed = excluded.passed,
+        completed_at = excluded.completed_at
+'''
+SELECT_USER_COURSE_SCORE = '''
+    SELECT total_score, max_score, score_percent, passed, completed_at
+    FROM course_scores
+    WHERE user_id = ? AND course_id = ?
+'''
+SELECT_USER_QUIZ_HISTORY = '''
+    SELECT question_id, selected_answers, is_correct, score_earned, attempted_at
+    FROM quiz_results
+    WHERE user_id = ? AND course_id = ?
+    ORDER BY attempted_at DESC
+'''
+INSERT_NOTIFICATION_LOG = '''
+    INSERT INTO notification_logs
+    (user_id, course_id, notification_type, recipient_email, status)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SELECT_ADMIN_STATISTICS = '''
+    SELECT
+        (SELECT COUNT(*) FROM users WHERE role = 'student') AS total_users,
+        (SELECT COUNT(*) FROM courses) AS total_courses,
+        (SELECT COUNT(*) FROM course_scores WHERE passed = 1) AS completed_users,
+        (SELECT COALESCE(AVG(score_percent), 0) FROM course_scores) AS average_score
+'''
+
+# ログイン試行ログ
+INSERT_LOGIN_LOG = '''
+    INSERT INTO login_logs 
+    (user_id, username, status, ip_address, user_agent, error_message)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SELECT_LOGIN_LOGS_BY_USER = '''
+    SELECT log_id, user_id, username, status, ip_address, 
+           error_message, attempted_at
+    FROM login_logs
+    WHERE user_id = ?
+    ORDER BY attempted_at DESC
+    LIMIT ?
+'''
+SELECT_LOGIN_LOGS = '''
+    SELECT log_id, user_id, username, status, ip_address, 
+           error_message, attempted_at
+    FROM login_logs
+    ORDER BY attempted_at DESC
+    LIMIT ?
+'''
+
+
+# ===== SQLプロファイラ（環境変数 ELEARNING_SQL_PROFILE を設定したときのみ有効） =====
+
+_SQL_PROFILE_ENABLED = bool(os.environ.get("ELEARNING_SQL_PROFILE"))
+# ステートメントごとに保持する直近の実行時間（ナノ秒）の件数
+_SQL_PROFILE_SAMPLES = 1000
+# この回数実行するごとに p50/p99 を出力
+_SQL_PROFILE_REPORT_EVERY = 1000
+
+_SQL_PROFILE: Dict[str, deque] = {}
+_SQL_PROFILE_LOCK = threading.Lock()
+_sql_profile_count = 0
+
+
+def _record_sql_timing(sql: str, elapsed_ns: int) -> None:
+    """SQLの実行時間を記録し、一定回数ごとに集計結果を出力"""
+    global _sql_profile_count
+    with _SQL_PROFILE_LOCK:
+        samples = _SQL_PROFILE.get(sql)
+        if samples is None:
+            samples = _SQL_PROFILE[sql] = deque(maxlen=_SQL_PROFILE_SAMPLES)
+        samples.append(elapsed_ns)
+        _sql_profile_count += 1
+        report = _sql_profile_count % _SQL_PROFILE_REPORT_EVERY == 0
+    if report:
+        print_sql_profile()
+
+
+def get_sql_profile() -> Dict[str, Dict[str, float]]:
+    """ステートメントごとの実行回数と p50/p99（マイクロ秒）を取得"""
+    with _SQL_PROFILE_LOCK:
+        snapshot = {sql: sorted(samples) for sql, samples in _SQL_PROFILE.items()}
+    
+    profile = {}
+    for sql, samples in snapshot.items():
+        n = len(samples)
+        profile[" ".join(sql.split())] = {
+            "count": n,
+            "p50_us": samples[n // 2] / 1000,
+            "p99_us": samples[min(n - 1, n * 99 // 100)] / 1000,
+        }
+    return profile
+
+
+def print_sql_profile() -> None:
+    """p99の遅い順にSQLプロファイルを出力"""
+    profile = get_sql_profile()
+    print("SQLプロファイル（p50/p99 マイクロ秒）:")
+    for sql, stats in sorted(profile.items(), key=lambda kv: kv[1]["p99_us"], reverse=True):
+        print(f"  p50={stats['p50_us']:.1f} p99={stats['p99_us']:.1f} "
+              f"n={stats['count']} {sql[:100]}")
+
+
+class _ProfilingCursor(sqlite3.Cursor):
+    """execute/executemany の実行時間を記録するカーソル"""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter_ns()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_sql_timing(sql, time.perf_counter_ns() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter_ns()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_sql_timing(sql, time.perf_counter_ns() - start)
+
+
+class _ProfilingConnection(sqlite3.Connection):
+    """プロファイル用カーソルを返す接続"""
+    
+    def cursor(self, factory=_ProfilingCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+_CONNECTION_FACTORY = _ProfilingConnection if _SQL_PROFILE_ENABLED else sqlite3.Connection
+
+
+def _writer_loop(manager_ref: "weakref.ref[DatabaseManager]", write_queue: queue.Queue) -> None:
+    """バックグラウンド書き込みスレッド：キューに届いた書き込みをまとめてコミット
+    
+    キューの要素は (SQL, パラメータ) のタプル、flush_writes の完了通知用 Event、
+    または終了指示の None。
+    """
+    while True:
+        item = write_queue.get()
+        batch = []
+        waiters = []
+        stop = False
+        deadline = time.monotonic() + _WRITE_BATCH_WINDOW
+        while True:
+            if item is None:
+                stop = True
+                break
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+                break
+            batch.append(item)
+            timeout = deadline - time.monotonic()
+            if len(batch) >= _WRITE_BATCH or timeout <= 0:
+                break
+            try:
+                item = write_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+        
+        if batch:
+            manager = manager_ref()
+            if manager is not None:
+                manager._write_batch(batch)
+            del manager
+        for waiter in waiters:
+            waiter.set()
+        if stop:
+            return
+
+
+def _close_at_exit(manager_ref: "weakref.ref[DatabaseManager]") -> None:
+    """終了時にキュー中の書き込みを書き出して接続を閉じる（弱参照でインスタンスの解放を妨げない）"""
+    manager = manager_ref()
+    if manager is not None:
+        manager.close()
+
+
+def _maintenance_tick(manager_ref: "weakref.ref[DatabaseManager]") -> None:
+    """定期メンテナンスを実行して次回を予約（弱参照でインスタンスの解放を妨げない）"""
+    manager = manager_ref()
+    if manager is None:
+        return
+    with manager._wlock:
+        if manager._maintenance_timer is None:
+            return
+        manager.optimize()
+        manager.checkpoint()
+        manager._schedule_maintenance()
+
 
 class DatabaseManager:
     """SQLiteデータベース管理クラス"""
@@ -20,12 +386,175 @@ class DatabaseManager:
         Args:
             db_path: データベースファイルのパス
         """
+        if sqlite3.sqlite_version_info < _MIN_SQLITE_VERSION:
+            raise RuntimeError(
+                f"SQLite {'.'.join(map(str, _MIN_SQLITE_VERSION))} 以降が必要です"
+                f"（現在のバージョン: {sqlite3.sqlite_version}）。"
+                "新しいSQLiteにリンクされたPythonを使用してください。")
+        
         self.db_path = db_path
+        # 書き込みは単一接続＋ミューテックス、読み取りは読み取り専用接続（WALで並行可）
+        self._wconn: Optional[sqlite3.Connection] = None
+        self._rconn: Optional[sqlite3.Connection] = None
+        self._wlock = threading.RLock()
+        self._maintenance_timer: Optional[threading.Timer] = None
         self.init_database()
+        self._schedule_maintenance()
+        # ログ・回答結果はキューに積み、専用スレッドがまとめて書き込む
+        self._write_queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = threading.Thread(
+            target=_writer_loop, args=(weakref.ref(self), self._write_queue),
+            name="DatabaseManager-writer", daemon=True)
+        self._writer.start()
+        # 書き込みスレッドはデーモンのため、通常終了時もキュー中の書き込みを失わないよう閉じる
+        atexit.register(_close_at_exit, weakref.ref(self))
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """書き込み用の共有接続を取得（初回呼び出し時のみ接続を開く）"""
+        with self._wlock:
+            if self._wconn is None:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                       cached_statements=_CACHED_STATEMENTS,
+                                       factory=_CONNECTION_FACTORY)
+                conn.row_factory = sqlite3.Row
+                self._apply_pragmas(conn)
+                self._wconn = conn
+            return self._wconn
+    
+    def get_read_connection(self) -> sqlite3.Connection:
+        """読み取り専用の共有接続を取得（:memory: の場合は書き込み用接続を共用）"""
+        if self.db_path == ":memory:":
+            return self.get_connection()
+        if self._rconn is None:
+            with self._wlock:
+                if self._rconn is None:
+                    uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+                    conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                           cached_statements=_CACHED_STATEMENTS,
+                                           factory=_CONNECTION_FACTORY)
+                    conn.row_factory = sqlite3.Row
+                    self._apply_pragmas(conn, readonly=True)
+                    self._rconn = conn
+        return self._rconn
+    
+    def close(self):
+        """共有データベース接続を閉じる（キュー中の書き込みは先に書き出す）"""
+        writer = self._writer
+        if writer is not None:
+            self._writer = None
+            self._write_queue.put(None)
+            if writer is not threading.current_thread():
+                writer.join()
+        with self._wlock:
+            if self._maintenance_timer is not None:
+                self._maintenance_timer.cancel()
+                self._maintenance_timer = None
+            self.optimize()
+            for conn in (self._rconn, self._wconn):
+                if conn is not None:
+                    conn.close()
+            self._rconn = None
+            self._wconn = None
+    
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+    
+    def _schedule_maintenance(self):
+        """次回の定期メンテナンスを予約"""
+        timer = threading.Timer(_MAINTENANCE_INTERVAL, _maintenance_tick,
+                                args=(weakref.ref(self),))
+        timer.daemon = True
+        timer.start()
+        self._maintenance_timer = timer
+    
+    def optimize(self):
+        """PRAGMA optimize でクエリプランナーの統計情報を更新"""
+        with self._wlock:
+            if self._wconn is None:
+                return
+            try:
+                self._wconn.execute("PRAGMA optimize;")
+            except Exception as e:
+                print(f"エラー: PRAGMA optimize に失敗しました: {e}")
+    
+    def checkpoint(self) -> bool:
+        """
+        WALの内容をDBファイルへ書き戻し、WALファイルを切り詰める
+        
+        読み取り中の接続があれば待たずに書き戻せた分だけで終える
+        （書き込みロックを持ったまま読み取りの終了を待つと、他の書き込みがすべて止まるため）
+        
+        Returns:
+            WALを切り詰められたらTrue、読み取り中のためスキップしたらFalse
+        """
+        if self.db_path == ":memory:":
+            return False
+        with self._wlock:
+            if self._wconn is None:
+                return False
+            try:
+                # ビジータイムアウトを0にして、読み取りの終了を待たずに試みる
+                self._wconn.execute("PRAGMA busy_timeout=0;")
+                try:
+                    busy = self._wconn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()[0]
+                finally:
+                    self._wconn.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_MS};")
+                return not busy
+            except Exception as e:
+                print(f"エラー: WALチェックポイントに失敗しました: {e}")
+                return False
+    
+    def _enqueue_write(self, sql: str, params: Tuple) -> None:
+        """書き込みをキューに積んで即座に戻る（close後の書き込みは接続を開き直さず破棄する）"""
+        if self._writer is None:
+            print("警告: データベースは閉じられているため、書き込みを破棄しました")
+            return
+        self._write_queue.put((sql, params))
+    
+    def _write_batch(self, batch: List[Tuple[str, Tuple]]) -> bool:
+        """キューから取り出した書き込みをSQLごとにexecutemanyし、1トランザクションでコミット"""
+        grouped: Dict[str, List[Tuple]] = {}
+        for sql, params in batch:
+            grouped.setdefault(sql, []).append(params)
+        
+        with self._wlock:
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                for sql, rows in grouped.items():
+                    cursor.executemany(sql, rows)
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: バックグラウンド書き込みに失敗しました: {e}")
+                return False
+    
+    def flush_writes(self) -> None:
+        """キューに積まれた書き込みがすべてコミットされるまで待つ"""
+        writer = self._writer
+        if writer is None or not writer.is_alive():
+            return
+        done = threading.Event()
+        self._write_queue.put(done)
+        done.wait()
     
-    def get_connection(self):
-        """データベース接続を取得"""
-        return sqlite3.connect(self.db_path)
+    def _apply_pragmas(self, conn: sqlite3.Connection, readonly: bool = False):
+        """接続ごとのPRAGMAを設定（WAL・同期モード・キャッシュ）"""
+        # WALはファイルDBのみ有効（:memory: では使用しない）
+        if self.db_path != ":memory:" and not readonly:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            # 1000ページごとに自動チェックポイントし、チェックポイント後のWALは64MBまで切り詰める
+            conn.execute("PRAGMA wal_autocheckpoint=1000;")
+            conn.execute("PRAGMA journal_size_limit=67108864;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-64000;")
+        conn.execute("PRAGMA mmap_size=268435456;")
+        conn.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_MS};")
     
     def init_database(self):
         """データベーステーブルを初期化"""
@@ -41,13 +570,15 @@ class DatabaseManager:
                 email TEXT,
                 full_name TEXT,
                 role TEXT DEFAULT 'student',
-                status TEXT DEFAULT 'active',
+                status TEXT DEFAULT 'active'
+                    CHECK(status IN ('active', 'suspended', 'disabled')),
                 failed_login_count INTEGER DEFAULT 0,
-                locked_until TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
+                locked_until INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                last_login TEXT
+            ) STRICT
         ''')
+        cursor.execute(MIGRATE_LOCKED_UNTIL_EPOCH)
         
         # コース情報テーブル
         cursor.execute('''
@@ -128,29 +659,112 @@ class DatabaseManager:
             )
         ''')
         
+        # 検索用インデックス（履歴・成績・ログイン履歴の絞り込み/並び替え）
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_quiz_results_user_course
+            ON quiz_results(user_id, course_id, attempted_at DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_course_scores_user_course
+            ON course_scores(user_id, course_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_login_logs_user_time
+            ON login_logs(user_id, attempted_at DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_login_logs_time
+            ON login_logs(attempted_at DESC)
+        ''')
+        
+        # 統計情報がまだなければANALYZEで作成し、クエリプランナーにインデックスを使わせる
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            cursor.execute("ANALYZE;")
+        
         conn.commit()
-        conn.close()
+        
+        conn.execute("PRAGMA optimize;")
     
-    # ===== コース管理 =====
-        """パスワードをハッシュ化"""
-        return hashlib.sha256(password.encode()).hexdigest()
+    # ===== ユーザー管理 =====
     
-    def add_user(self, username: str, password: str, email: str = "", 
-                 full_name: str = "", role: str = "student") -> bool:
-        """新規ユーザーを追加"""
+    def hash_password(self, password: str) -> str:
+        """パスワードをハッシュ化（Argon2id）"""
+        return _PASSWORD_HASHER.hash(password)
+    
+    def verify_password(self, stored_hash: str, password: str) -> bool:
+        """パスワードを照合（旧形式のSHA-256ハッシュにも対応）"""
+        if _LEGACY_SHA256_HASH.fullmatch(stored_hash):
+            provided_hash = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(stored_hash, provided_hash)
+        
+        key = (stored_hash, hmac.new(_FAILED_VERIFY_KEY, password.encode(), 'sha256').digest())
+        with _FAILED_VERIFY_LOCK:
+            if key in _FAILED_VERIFY_CACHE:
+                _FAILED_VERIFY_CACHE.move_to_end(key)
+                return False
+        
+        try:
+            return _PASSWORD_HASHER.verify(stored_hash, password)
+        except VerifyMismatchError:
+            with _FAILED_VERIFY_LOCK:
+                _FAILED_VERIFY_CACHE[key] = False
+                if len(_FAILED_VERIFY_CACHE) > _FAILED_VERIFY_CACHE_SIZE:
+                    _FAILED_VERIFY_CACHE.popitem(last=False)
+            return False
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def _needs_rehash(self, stored_hash: str) -> bool:
+        """旧形式・旧パラメータのハッシュかどうか"""
+        if _LEGACY_SHA256_HASH.fullmatch(stored_hash):
+            return True
         try:
+            return _PASSWORD_HASHER.check_needs_rehash(stored_hash)
+        except InvalidHashError:
+            return True
+    
+    def add_user(self, username: str, password: str, email: str = "", 
+                 full_name: str = "", role: str = "student") -> Optional[int]:
+        """新規ユーザーを追加（成功時は作成したユーザーID、既存ユーザーならNone）"""
+        password_hash = self.hash_password(password)
+        with self._wlock:
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(INSERT_USER, (username, password_hash, email, full_name, role))
+                conn.commit()
+                return cursor.lastrowid
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return None
+    
+    def upsert_sso_user(self, username: str, email: str = "", full_name: str = "",
+                        role: str = "student") -> Optional[int]:
+        """
+        SSOで認証済みのユーザーを登録・更新してユーザーIDを返す
+        
+        存在確認・追加・ID取得を1回のINSERT ... ON CONFLICT ... RETURNINGで行う。
+        パスワードは照合しない（認証はAzure AD側で完了している）。
+        
+        Returns:
+            有効なユーザーならユーザーID、無効・停止中ならNone
+        """
+        with self._wlock:
             conn = self.get_connection()
             cursor = conn.cursor()
-            password_hash = self.hash_password(password)
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, email, full_name, role)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (username, password_hash, email, full_name, role))
+            cursor.execute(UPSERT_SSO_USER, (username, _SSO_PASSWORD_HASH, email,
+                                             full_name, role, _now()))
+            user_id, status = cursor.fetchone()
             conn.commit()
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+        
+        if status != 'active':
+            self._log_login_attempt(user_id, username, "failed",
+                                    error_message=f"ユーザーステータス: {status}")
+            return None
+        
+        self._log_login_attempt(user_id, username, "success")
+        return user_id
     
     def authenticate_user(self, username: str, password: str, 
                           ip_address: str = "", user_agent: str = "") -> Optional[Dict]:
@@ -161,66 +775,64 @@ class DatabaseManager:
             成功時: {"user_id": id, "status": "success"}
             失敗時: {"status": "failed", "message": "エラーメッセージ"}
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # ユーザーを検索
-        cursor.execute('''
-            SELECT user_id, password_hash, status, failed_login_count, locked_until
-            FROM users WHERE username = ?
-        ''', (username,))
-        
-        result = cursor.fetchone()
-        
-        # ユーザーが存在しない
-        if not result:
-            self._log_login_attempt(None, username, "failed", ip_address, user_agent, 
-                                   "ユーザーが見つかりません")
-            conn.close()
-            return {
-                "status": "failed",
-                "message": "ユーザー名またはパスワードが正しくありません"
-            }
-        
-        user_id, password_hash, status, failed_count, locked_until = result
+        # 有効かつロックされていないユーザーの失敗回数を先に加算し、
+        # 照合に必要な情報を1回のUPDATE ... RETURNINGで取得する
+        with self._wlock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(CLAIM_LOGIN_ATTEMPT, (username, int(time.time())))
+            claimed = cursor.fetchall()
+            conn.commit()
+            
+            if not claimed:
+                # 失敗理由の特定（存在しない・無効・ロック中）
+                cursor.execute(SELECT_USER_AUTH, (username,))
+                result = cursor.fetchone()
         
-        # チェック1: ユーザーが無効・停止中
-        if status != 'active':
+        if not claimed:
+            # ユーザーが存在しない
+            if not result:
+                self._log_login_attempt(None, username, "failed", ip_address, user_agent, 
+                                       "ユーザーが見つかりません")
+                return {
+                    "status": "failed",
+                    "message": "ユーザー名またはパスワードが正しくありません"
+                }
+            
+            user_id, status, locked_until = result
+            
+            # チェック1: ユーザーが無効・停止中
+            if status != 'active':
+                self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
+                                       f"ユーザーステータス: {status}")
+                return {
+                    "status": "failed",
+                    "message": f"このアカウントは {status} です。管理者に連絡してください。"
+                }
+            
+            # 照合と確認の間に別プロセスでロックが解除された場合は、再試行を促す
+            if locked_until is None:
+                self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
+                                       "ロック状態が確認中に変更されました")
+                return {
+                    "status": "failed",
+                    "message": "ユーザー名またはパスワードが正しくありません"
+                }
+            
+            # チェック2: ロックアウト中
+            # locked_until はUNIX時刻（秒）
+            remaining_minutes = max(0, (int(locked_until) - int(time.time())) // 60)
             self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
-                                   f"ユーザーステータス: {status}")
-            conn.close()
+                                   f"アカウントロック中（残り{remaining_minutes}分）")
             return {
                 "status": "failed",
-                "message": f"このアカウントは {status} です。管理者に連絡してください。"
+                "message": f"アカウントがロックされています。{remaining_minutes}分後に再度お試しください。"
             }
         
-        # チェック2: ロックアウト中
-        if locked_until:
-            locked_until_dt = datetime.fromisoformat(locked_until)
-            if datetime.now() < locked_until_dt:
-                remaining_minutes = int((locked_until_dt - datetime.now()).total_seconds() / 60)
-                self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
-                                       f"アカウントロック中（残り{remaining_minutes}分）")
-                conn.close()
-                return {
-                    "status": "failed",
-                    "message": f"アカウントがロックされています。{remaining_minutes}分後に再度お試しください。"
-                }
-            else:
-                # ロック期間が終了したのでリセット
-                cursor.execute('''
-                    UPDATE users SET failed_login_count = 0, locked_until = NULL
-                    WHERE user_id = ?
-                ''', (user_id,))
-                conn.commit()
-                failed_count = 0
+        user_id, password_hash, new_failed_count = claimed[0]
         
-        # チェック3: パスワードが正しい
-        provided_hash = self.hash_password(password)
-        if password_hash != provided_hash:
-            # ログイン失敗カウントをインクリメント
-            new_failed_count = failed_count + 1
-            
+        # チェック3: パスワードが正しい（書き込みロックの外で照合）
+        if not self.verify_password(password_hash, password):
             # 設定から失敗上限と ロックアウト時間を読み込む
             config = self._load_config()
             max_attempts = config.get('users', {}).get('max_login_attempts', 5)
@@ -228,45 +840,40 @@ class DatabaseManager:
             
             # 失敗回数が上限を超えたらロック
             if new_failed_count >= max_attempts:
-                locked_until = datetime.now() + timedelta(minutes=lockout_minutes)
-                cursor.execute('''
-                    UPDATE users 
-                    SET failed_login_count = ?, locked_until = ?
-                    WHERE user_id = ?
-                ''', (new_failed_count, locked_until, user_id))
+                locked_until = int(time.time()) + lockout_minutes * 60
+                with self._wlock:
+                    conn = self.get_connection()
+                    conn.execute(LOCK_USER, (locked_until, user_id))
+                    conn.commit()
                 self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
                                        f"パスワード不一致 - ロック中（{lockout_minutes}分）")
-                conn.commit()
-                conn.close()
                 return {
                     "status": "failed",
                     "message": f"パスワードが正しくありません。{max_attempts}回失敗したため、アカウントが{lockout_minutes}分間ロックされました。"
                 }
             else:
-                # まだロックされない
-                cursor.execute('''
-                    UPDATE users SET failed_login_count = ? WHERE user_id = ?
-                ''', (new_failed_count, user_id))
+                # まだロックされない（失敗回数は加算済み）
                 remaining_attempts = max_attempts - new_failed_count
                 self._log_login_attempt(user_id, username, "failed", ip_address, user_agent,
                                        f"パスワード不一致（残り{remaining_attempts}回）")
-                conn.commit()
-                conn.close()
                 return {
                     "status": "failed",
                     "message": f"パスワードが正しくありません。残り {remaining_attempts} 回試行できます。"
                 }
         
+        # 旧形式のハッシュはログイン成功時にArgon2idへ移行
+        new_hash = self.hash_password(password) if self._needs_rehash(password_hash) else None
+        
         # ログイン成功！
-        cursor.execute('''
-            UPDATE users 
-            SET last_login = ?, failed_login_count = 0, locked_until = NULL
-            WHERE user_id = ?
-        ''', (datetime.now(), user_id))
+        with self._wlock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute(UPDATE_LOGIN_SUCCESS, (_now(), user_id))
+            if new_hash:
+                cursor.execute(UPDATE_PASSWORD_HASH, (new_hash, user_id))
+            conn.commit()
         
         self._log_login_attempt(user_id, username, "success", ip_address, user_agent, None)
-        conn.commit()
-        conn.close()
         
         return {
             "status": "success",
@@ -274,39 +881,20 @@ class DatabaseManager:
         }
     
     def _load_config(self) -> Dict:
-        """設定ファイルを読み込む"""
+        """設定ファイルを読み込む（更新がなければ前回の解析結果を返す）"""
         try:
-            if Path("config.yaml").exists():
-                with open("config.yaml", 'r', encoding='utf-8') as f:
-                    return yaml.safe_load(f) or {}
-        except:
-            pass
-        return {}
+            return cached_read("config.yaml", parse_yaml) or {}
+        except Exception:
+            return {}
     
     def get_user_info(self, user_id: int) -> Optional[Dict]:
         """ユーザー情報を取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id, username, email, full_name, role, status, created_at, last_login
-            FROM users WHERE user_id = ?
-        ''', (user_id,))
+        cursor = self.get_read_connection().cursor()
+        cursor.execute(SELECT_USER_INFO, (user_id,))
         
         result = cursor.fetchone()
-        conn.close()
         
-        if result:
-            return {
-                "user_id": result[0],
-                "username": result[1],
-                "email": result[2],
-                "full_name": result[3],
-                "role": result[4],
-                "status": result[5],
-                "created_at": result[6],
-                "last_login": result[7]
-            }
-        return None
+        return dict(result) if result else None
     
     # ===== コース管理 =====
     
@@ -315,68 +903,55 @@ class DatabaseManager:
                    access_start_date: str = "", access_end_date: str = "",
                    quiz_time_limit: int = 300, passing_score: int = 70) -> bool:
         """新規コースを追加"""
-        try:
+        with self._wlock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO courses 
-                (course_name, description, pdf_path, pptx_path, 
-                 access_start_date, access_end_date, quiz_time_limit_seconds, passing_score_percent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (course_name, description, pdf_path, pptx_path,
-                  access_start_date, access_end_date, quiz_time_limit, passing_score))
-            conn.commit()
-            course_id = cursor.lastrowid
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+            try:
+                cursor = conn.cursor()
+                cursor.execute(INSERT_COURSE, (course_name, description, pdf_path, pptx_path,
+                                               access_start_date, access_end_date,
+                                               quiz_time_limit, passing_score))
+                conn.commit()
+                return True
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return False
     
     def get_courses(self) -> List[Dict]:
         """すべてのコースを取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT course_id, course_name, description, quiz_time_limit_seconds,
-                   passing_score_percent, created_at
-            FROM courses ORDER BY created_at DESC
-        ''')
-        
-        courses = []
-        for row in cursor.fetchall():
-            courses.append({
-                "course_id": row[0],
-                "course_name": row[1],
-                "description": row[2],
-                "quiz_time_limit": row[3],
-                "passing_score": row[4],
-                "created_at": row[5]
-            })
-        
-        conn.close()
-        return courses
+        cursor = self.get_read_connection().cursor()
+        return [dict(row) for row in cursor.execute(SELECT_COURSES)]
     
     # ===== 採点・結果管理 =====
     
     def save_quiz_result(self, user_id: int, course_id: int, question_id: int,
                          selected_answers: List[str], is_correct: bool, 
                          score_earned: int) -> bool:
-        """クイズの回答結果を保存"""
-        try:
+        """クイズの回答結果を保存（書き込みスレッドのキューに積んで即座に戻る）"""
+        answers_json = _json_dumps(selected_answers)
+        self._enqueue_write(INSERT_QUIZ_RESULT, (user_id, course_id, question_id,
+                                                 answers_json, is_correct, score_earned))
+        return True
+    
+    def save_quiz_results_bulk(self, user_id: int, course_id: int,
+                               results: List[Dict[str, Any]]) -> bool:
+        """
+        クイズの回答結果をまとめて保存（1トランザクション・1コミット）
+        
+        Args:
+            results: save_quiz_result と同じ項目（question_id, selected_answers,
+                     is_correct, score_earned）を持つ辞書のリスト
+        """
+        data = _quiz_result_rows(user_id, course_id, results)
+        with self._wlock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            answers_json = json.dumps(selected_answers, ensure_ascii=False)
-            cursor.execute('''
-                INSERT INTO quiz_results 
-                (user_id, course_id, question_id, selected_answers, is_correct, score_earned)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, course_id, question_id, answers_json, is_correct, score_earned))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"エラー: 結果の保存に失敗しました: {e}")
-            return False
+            try:
+                conn.executemany(INSERT_QUIZ_RESULT, data)
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: 結果の保存に失敗しました: {e}")
+                return False
     
     def save_course_score(self, user_id: int, course_id: int, 
                           total_score: int, max_score: int,
@@ -385,244 +960,176 @@ class DatabaseManager:
         score_percent = (total_score / max_score * 100) if max_score > 0 else 0
         passed = score_percent >= passing_score_percent
         
-        try:
+        with self._wlock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # 既存の記録があれば更新、なければ挿入
-            cursor.execute('''
-                INSERT OR REPLACE INTO course_scores
-                (user_id, course_id, total_score, max_score, score_percent, passed, completed_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, course_id, total_score, max_score, score_percent, passed, datetime.now()))
-            
-            conn.commit()
-            conn.close()
-            
-            return {
-                "total_score": total_score,
-                "max_score": max_score,
-                "score_percent": round(score_percent, 2),
-                "passed": passed
-            }
-        except Exception as e:
-            print(f"エラー: 成績の保存に失敗しました: {e}")
-            return {}
+            try:
+                cursor = conn.cursor()
+                
+                # 既存の記録があれば更新、なければ挿入
+                cursor.execute(SAVE_COURSE_SCORE, (user_id, course_id, total_score, max_score,
+                                                   score_percent, passed, _now()))
+                
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: 成績の保存に失敗しました: {e}")
+                return {}
+        
+        return {
+            "total_score": total_score,
+            "max_score": max_score,
+            "score_percent": round(score_percent, 2),
+            "passed": passed
+        }
+    
+    def save_quiz_submission(self, user_id: int, course_id: int,
+                             results: List[Dict[str, Any]], total_score: int,
+                             max_score: int, passing_score_percent: int) -> Dict:
+        """
+        クイズ提出（全問の回答結果とコースの最終得点）を1トランザクションで保存
+        
+        Args:
+            results: save_quiz_results_bulk と同じ形式の回答結果リスト
+        
+        Returns:
+            save_course_score と同じ形式の成績（失敗時は空の辞書）
+        """
+        score_percent = (total_score / max_score * 100) if max_score > 0 else 0
+        passed = score_percent >= passing_score_percent
+        data = _quiz_result_rows(user_id, course_id, results)
+        
+        with self._wlock:
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(INSERT_QUIZ_RESULT, data)
+                cursor.execute(SAVE_COURSE_SCORE, (user_id, course_id, total_score, max_score,
+                                                   score_percent, passed, _now()))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: クイズ結果の保存に失敗しました: {e}")
+                return {}
+        
+        return {
+            "total_score": total_score,
+            "max_score": max_score,
+            "score_percent": round(score_percent, 2),
+            "passed": passed
+        }
     
     def get_user_course_score(self, user_id: int, course_id: int) -> Optional[Dict]:
         """ユーザーのコース成績を取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT total_score, max_score, score_percent, passed, completed_at
-            FROM course_scores
-            WHERE user_id = ? AND course_id = ?
-        ''', (user_id, course_id))
+        cursor = self.get_read_connection().cursor()
+        cursor.execute(SELECT_USER_COURSE_SCORE, (user_id, course_id))
         
         result = cursor.fetchone()
-        conn.close()
         
-        if result:
-            return {
-                "total_score": result[0],
-                "max_score": result[1],
-                "score_percent": result[2],
-                "passed": result[3],
-                "completed_at": result[4]
-            }
-        return None
+        return dict(result) if result else None
     
-    def get_user_quiz_history(self, user_id: int, course_id: int) -> List[Dict]:
-        """ユーザーのクイズ回答履歴を取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT question_id, selected_answers, is_correct, score_earned, attempted_at
-            FROM quiz_results
-            WHERE user_id = ? AND course_id = ?
-            ORDER BY attempted_at DESC
-        ''', (user_id, course_id))
+    def get_user_quiz_history(self, user_id: int, course_id: int,
+                              questions: Optional[List[Dict]] = None) -> List[Dict]:
+        """ユーザーのクイズ回答履歴を取得
+        
+        Args:
+            questions: 問題リスト（questions.json の内容）。指定すると各履歴に
+                question_text と correct_answers を付与する
+        """
+        # 問題はDBではなくJSONで管理しているため、問題ごとの再検索をせず辞書で一度に結合する
+        question_map = {q["id"]: q for q in questions} if questions else {}
         
+        # 書き込みスレッドに残っている回答結果も結果に含める
+        self.flush_writes()
+        cursor = self.get_read_connection().cursor()
+        cursor.execute(SELECT_USER_QUIZ_HISTORY, (user_id, course_id))
         history = []
-        for row in cursor.fetchall():
-            history.append({
-                "question_id": row[0],
-                "selected_answers": json.loads(row[1]),
-                "is_correct": row[2],
-                "score_earned": row[3],
-                "attempted_at": row[4]
-            })
-        
-        conn.close()
+        for row in cursor:
+            entry = dict(row)
+            entry["selected_answers"] = _json_loads(entry["selected_answers"])
+            if questions is not None:
+                q = question_map.get(entry["question_id"])
+                entry["question_text"] = q["question"] if q else None
+                entry["correct_answers"] = (
+                    [c["letter"] for c in q["choices"] if c["is_correct"]] if q else None
+                )
+            history.append(entry)
+        
         return history
     
     def log_notification(self, user_id: int, course_id: int, 
                          notification_type: str, recipient_email: str, 
                          status: str = "sent") -> bool:
-        """通知ログを記録"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO notification_logs
-                (user_id, course_id, notification_type, recipient_email, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, course_id, notification_type, recipient_email, status))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"エラー: 通知ログの記録に失敗しました: {e}")
-            return False
+        """通知ログを記録（書き込みスレッドのキューに積んで即座に戻る）"""
+        self._enqueue_write(INSERT_NOTIFICATION_LOG, (user_id, course_id, notification_type,
+                                                      recipient_email, status))
+        return True
     
     def get_admin_statistics(self) -> Dict:
         """管理者向け統計情報を取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # ユーザー数
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "student"')
-        total_users = cursor.fetchone()[0]
-        
-        # コース数
-        cursor.execute('SELECT COUNT(*) FROM courses')
-        total_courses = cursor.fetchone()[0]
-        
-        # 完了者数
-        cursor.execute('SELECT COUNT(*) FROM course_scores WHERE passed = 1')
-        completed_users = cursor.fetchone()[0]
-        
-        # 平均スコア
-        cursor.execute('SELECT AVG(score_percent) FROM course_scores')
-        avg_score = cursor.fetchone()[0] or 0
+        # ユーザー数・コース数・完了者数・平均スコアを1クエリで集計
+        stats = dict(self.get_read_connection().execute(SELECT_ADMIN_STATISTICS).fetchone())
+        stats["average_score"] = round(stats["average_score"], 2)
         
-        conn.close()
-        
-        return {
-            "total_users": total_users,
-            "total_courses": total_courses,
-            "completed_users": completed_users,
-            "average_score": round(avg_score, 2)
-        }
+        return stats
     
     # ===== ユーザーステータス管理 =====
     
     def update_user_status(self, user_id: int, status: str) -> bool:
         """ユーザーステータスを更新（active/suspended/disabled）"""
+        # CHECK制約は新規作成したDBにしかないため、既存DB向けにここでも検証する
         if status not in ['active', 'suspended', 'disabled']:
             return False
         
-        try:
+        with self._wlock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users SET status = ? WHERE user_id = ?
-            ''', (status, user_id))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"エラー: ステータス更新に失敗: {e}")
-            return False
+            try:
+                cursor = conn.cursor()
+                cursor.execute(UPDATE_USER_STATUS, (status, user_id))
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: ステータス更新に失敗: {e}")
+                return False
     
     def unlock_user(self, user_id: int) -> bool:
         """ユーザーのロックアウトを解除"""
-        try:
+        with self._wlock:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET failed_login_count = 0, locked_until = NULL
-                WHERE user_id = ?
-            ''', (user_id,))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"エラー: ロック解除に失敗: {e}")
-            return False
+            try:
+                cursor = conn.cursor()
+                cursor.execute(RESET_USER_LOCK, (user_id,))
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"エラー: ロック解除に失敗: {e}")
+                return False
     
     def _log_login_attempt(self, user_id: Optional[int], username: str, 
                           status: str, ip_address: str = "", 
                           user_agent: str = "", error_message: str = None) -> bool:
-        """ログイン試行をログテーブルに記録"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO login_logs 
-                (user_id, username, status, ip_address, user_agent, error_message)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, status, ip_address, user_agent, error_message))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"エラー: ログイン試行ログの記録に失敗: {e}")
-            return False
+        """ログイン試行をログテーブルに記録（書き込みスレッドのキューに積んで即座に戻る）"""
+        self._enqueue_write(INSERT_LOGIN_LOG, (user_id, username, status, ip_address,
+                                               user_agent, error_message))
+        return True
     
     def get_login_logs(self, user_id: int = None, limit: int = 50) -> List[Dict]:
         """ログイン試行ログを取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        # 未書き込みのログも結果に含める
+        self.flush_writes()
+        cursor = self.get_read_connection().cursor()
         
         if user_id:
-            cursor.execute('''
-                SELECT log_id, user_id, username, status, ip_address, 
-                       error_message, attempted_at
-                FROM login_logs
-                WHERE user_id = ?
-                ORDER BY attempted_at DESC
-                LIMIT ?
-            ''', (user_id, limit))
+            cursor.execute(SELECT_LOGIN_LOGS_BY_USER, (user_id, limit))
         else:
-            cursor.execute('''
-                SELECT log_id, user_id, username, status, ip_address, 
-                       error_message, attempted_at
-                FROM login_logs
-                ORDER BY attempted_at DESC
-                LIMIT ?
-            ''', (limit,))
-        
-        logs = []
-        for row in cursor.fetchall():
-            logs.append({
-                "log_id": row[0],
-                "user_id": row[1],
-                "username": row[2],
-                "status": row[3],
-                "ip_address": row[4],
-                "error_message": row[5],
-                "attempted_at": row[6]
-            })
-        
-        conn.close()
-        return logs
+            cursor.execute(SELECT_LOGIN_LOGS, (limit,))
+        
+        # 共有の読み取り接続で文を開いたままにしないよう、ここで読み切る
+        # （開いたままだと他の読み取りが古いスナップショットを見続け、チェックポイントも進まない）
+        return [dict(row) for row in cursor]
     
     def get_all_users(self) -> List[Dict]:
         """すべてのユーザー情報を取得"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id, username, email, full_name, role, status, 
-                   failed_login_count, last_login, created_at
-            FROM users
-            ORDER BY created_at DESC
-        ''')
-        
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                "user_id": row[0],
-                "username": row[1],
-                "email": row[2],
-                "full_name": row[3],
-                "role": row[4],
-                "status": row[5],
-                "failed_login_count": row[6],
-                "last_login": row[7],
-                "created_at": row[8]
-            })
-        
-        conn.close()
-        return users
+        cursor = self.get_read_connection().cursor()
+        return [dict(row) for row in cursor.execute(SELECT_ALL_USERS)]
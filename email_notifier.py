@@ -3,138 +3,93 @@ E-ラーニングシステム用メール通知モジュール
 クイズ完了時の結果通知・管理者への報告
 """
 
+import atexit
+import copy
 import smtplib
-import yaml
+import string
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
-from typing import List, Dict, Optional
-from pathlib import Path
+from typing import Any, Callable, List, Dict, Optional
 
+from file_cache import cached_read, parse_yaml
 
-class EmailNotifier:
-    """メール送信クラス"""
-    
-    def __init__(self, config_path: str = "config.yaml"):
-        """
-        Args:
-            config_path: 設定ファイルのパス
-        """
-        self.config = self._load_config(config_path)
-        self.smtp_server = self.config.get("email", {}).get("smtp_server", "smtp.gmail.com")
-        self.smtp_port = self.config.get("email", {}).get("smtp_port", 587)
-        self.sender_email = self.config.get("email", {}).get("sender_email", "")
-        self.sender_password = self.config.get("email", {}).get("sender_password", "")
-        self.admin_emails = self.config.get("email", {}).get("admin_emails", [])
-        self.mail_enabled = self.config.get("email", {}).get("enabled", False)
-    
-    def _load_config(self, config_path: str) -> Dict:
-        """YAML設定ファイルを読み込む"""
-        try:
-            if Path(config_path).exists():
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    return yaml.safe_load(f) or {}
-        except Exception as e:
-            print(f"警告: 設定ファイルの読み込みに失敗しました: {e}")
-        return {}
-    
-    def send_quiz_completion_email(self, user_name: str, user_email: str,
-                                    course_name: str, score_percent: float,
-                                    total_score: int, max_score: int,
-                                    passed: bool) -> bool:
-        """クイズ完了時のメールを送信（ユーザーへ）"""
-        if not self.mail_enabled:
-            print("メール通知は無効に設定されています")
-            return False
-        
-        subject = f"【{course_name}】クイズ完了のお知らせ"
-        
-        html_body = self._generate_completion_email_html(
-            user_name, course_name, score_percent, total_score, max_score, passed
-        )
-        
-        return self._send_email(user_email, subject, html_body)
-    
-    def send_admin_notification(self, user_name: str, user_email: str,
-                               course_name: str, score_percent: float,
-                               total_score: int, max_score: int,
-                               passed: bool) -> bool:
-        """クイズ完了時のメールを送信（管理者へ）"""
-        if not self.mail_enabled or not self.admin_emails:
-            print("管理者メール通知は無効に設定されています")
-            return False
-        
-        subject = f"【管理者報告】{user_name}が{course_name}を完了しました"
-        
-        html_body = self._generate_admin_notification_html(
-            user_name, user_email, course_name, score_percent, total_score, max_score, passed
-        )
-        
-        success = True
-        for admin_email in self.admin_emails:
-            if not self._send_email(admin_email, subject, html_body):
-                success = False
-        
-        return success
-    
-    def _generate_completion_email_html(self, user_name: str, course_name: str,
-                                        score_percent: float, total_score: int,
-                                        max_score: int, passed: bool) -> str:
-        """ユーザー向けメールのHTML生成"""
-        status = "✅ 合格" if passed else "❌ 不合格"
-        status_color = "#28a745" if passed else "#dc3545"
-        
-        html = f"""
+# 通知メール送信用のスレッドプール（終了時は未送信のメールを送り切ってから停止）
+_MAIL_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mail")
+atexit.register(_MAIL_POOL.shutdown, wait=True)
+
+
+def _session_dropped(error: smtplib.SMTPException) -> bool:
+    """送信失敗がサーバー側のセッション切断によるものか（421応答を含む）"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in error.recipients.values())
+    return False
+
+
+def send_in_background(fn: Callable[..., Any], *args, **kwargs) -> Future:
+    """メール送信処理をバックグラウンドで実行し、呼び出し元をSMTP通信で待たせない"""
+    return _MAIL_POOL.submit(fn, *args, **kwargs)
+
+
+# ===== メール本文テンプレート（起動時に一度だけ構築） =====
+
+_COMPLETION_EMAIL_TEMPLATE = string.Template("""
         <html>
         <head>
             <meta charset="UTF-8">
             <style>
-                body {{ font-family: 'Arial', sans-serif; margin: 0; padding: 20px; }}
-                .container {{ max-width: 600px; margin: 0 auto; }}
-                .header {{ background-color: #f8f9fa; padding: 20px; border-radius: 5px; }}
-                .content {{ padding: 20px; }}
-                .score-box {{ 
-                    background-color: {status_color}; 
+                body { font-family: 'Arial', sans-serif; margin: 0; padding: 20px; }
+                .container { max-width: 600px; margin: 0 auto; }
+                .header { background-color: #f8f9fa; padding: 20px; border-radius: 5px; }
+                .content { padding: 20px; }
+                .score-box { 
+                    background-color: $status_color; 
                     color: white; 
                     padding: 15px; 
                     border-radius: 5px; 
                     text-align: center; 
                     margin: 20px 0;
-                }}
-                .score-value {{ font-size: 32px; font-weight: bold; }}
-                .footer {{ background-color: #f8f9fa; padding: 15px; text-align: center; color: #666; }}
-                table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-                td {{ padding: 10px; border-bottom: 1px solid #ddd; }}
-                .label {{ font-weight: bold; background-color: #f0f0f0; width: 40%; }}
+                }
+                .score-value { font-size: 32px; font-weight: bold; }
+                .footer { background-color: #f8f9fa; padding: 15px; text-align: center; color: #666; }
+                table { width: 100%; border-collapse: collapse; margin: 20px 0; }
+                td { padding: 10px; border-bottom: 1px solid #ddd; }
+                .label { font-weight: bold; background-color: #f0f0f0; width: 40%; }
             </style>
         </head>
         <body>
             <div class="container">
                 <div class="header">
-                    <h2>{user_name}さんへ</h2>
+                    <h2>${user_name}さんへ</h2>
                     <p>クイズ完了のお知らせです。</p>
                 </div>
                 
                 <div class="content">
-                    <h3>【{course_name}】クイズ結果</h3>
+                    <h3>【${course_name}】クイズ結果</h3>
                     
                     <div class="score-box">
                         <div style="font-size: 18px; margin-bottom: 10px;">判定</div>
-                        <div class="score-value">{status}</div>
+                        <div class="score-value">$status</div>
                     </div>
                     
                     <table>
                         <tr>
                             <td class="label">取得点数</td>
-                            <td>{total_score} / {max_score}点</td>
+                            <td>$total_score / ${max_score}点</td>
                         </tr>
                         <tr>
                             <td class="label">正答率</td>
-                            <td>{score_percent:.1f}%</td>
+                            <td>${score_percent}%</td>
                         </tr>
                         <tr>
                             <td class="label">完了日時</td>
-                            <td>{datetime.now().strftime('%Y年%m月%d日 %H:%M')}</td>
+                            <td>$completed_at</td>
                         </tr>
                     </table>
                     
@@ -147,30 +102,22 @@ class EmailNotifier:
             </div>
         </body>
         </html>
-        """
-        return html
-    
-    def _generate_admin_notification_html(self, user_name: str, user_email: str,
-                                          course_name: str, score_percent: float,
-                                          total_score: int, max_score: int,
-                                          passed: bool) -> str:
-        """管理者向けメールのHTML生成"""
-        status = "合格" if passed else "不合格"
-        
-        html = f"""
+        """)
+
+_ADMIN_NOTIFICATION_TEMPLATE = string.Template("""
         <html>
         <head>
             <meta charset="UTF-8">
             <style>
-                body {{ font-family: 'Arial', sans-serif; margin: 0; padding: 20px; }}
-                .container {{ max-width: 600px; margin: 0 auto; }}
-                .header {{ background-color: #003366; color: white; padding: 20px; border-radius: 5px; }}
-                .content {{ padding: 20px; }}
-                .info-box {{ background-color: #f0f0f0; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-                .footer {{ background-color: #f8f9fa; padding: 15px; text-align: center; color: #666; }}
-                table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-                td {{ padding: 10px; border-bottom: 1px solid #ddd; }}
-                .label {{ font-weight: bold; background-color: #e0e0e0; width: 30%; }}
+                body { font-family: 'Arial', sans-serif; margin: 0; padding: 20px; }
+                .container { max-width: 600px; margin: 0 auto; }
+                .header { background-color: #003366; color: white; padding: 20px; border-radius: 5px; }
+                .content { padding: 20px; }
+                .info-box { background-color: #f0f0f0; padding: 15px; border-radius: 5px; margin: 20px 0; }
+                .footer { background-color: #f8f9fa; padding: 15px; text-align: center; color: #666; }
+                table { width: 100%; border-collapse: collapse; margin: 20px 0; }
+                td { padding: 10px; border-bottom: 1px solid #ddd; }
+                .label { font-weight: bold; background-color: #e0e0e0; width: 30%; }
             </style>
         </head>
         <body>
@@ -181,24 +128,24 @@ class EmailNotifier:
                 
                 <div class="content">
                     <div class="info-box">
-                        <p><strong>ユーザー:</strong> {user_name} ({user_email})</p>
-                        <p><strong>コース:</strong> {course_name}</p>
-                        <p><strong>完了日時:</strong> {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}</p>
+                        <p><strong>ユーザー:</strong> $user_name ($user_email)</p>
+                        <p><strong>コース:</strong> $course_name</p>
+                        <p><strong>完了日時:</strong> $completed_at</p>
                     </div>
                     
                     <h3>成績</h3>
                     <table>
                         <tr>
                             <td class="label">判定</td>
-                            <td><strong>{status}</strong></td>
+                            <td><strong>$status</strong></td>
                         </tr>
                         <tr>
                             <td class="label">得点</td>
-                            <td>{total_score} / {max_score}点</td>
+                            <td>$total_score / ${max_score}点</td>
                         </tr>
                         <tr>
                             <td class="label">正答率</td>
-                            <td>{score_percent:.1f}%</td>
+                            <td>${score_percent}%</td>
                         </tr>
                     </table>
                     
@@ -211,32 +158,177 @@ class EmailNotifier:
             </div>
         </body>
         </html>
+        """)
+
+
+class EmailNotifier:
+    """メール送信クラス"""
+    
+    def __init__(self, config_path: str = "config.yaml"):
         """
+        Args:
+            config_path: 設定ファイルのパス
+        """
+        self.config = self._load_config(config_path)
+        self.smtp_server = self.config.get("email", {}).get("smtp_server", "smtp.gmail.com")
+        self.smtp_port = self.config.get("email", {}).get("smtp_port", 587)
+        self.sender_email = self.config.get("email", {}).get("sender_email", "")
+        self.sender_password = self.config.get("email", {}).get("sender_password", "")
+        self.admin_emails = self.config.get("email", {}).get("admin_emails", [])
+        self.mail_enabled = self.config.get("email", {}).get("enabled", False)
+        # 認証済みSMTP接続（複数のメール送信で使い回す）
+        self._smtp: Optional[smtplib.SMTP] = None
+        # インスタンスは複数スレッドで共有されるため、SMTP接続の利用を直列化する
+        self._lock = threading.RLock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        """SMTP接続を閉じる"""
+        with self._lock:
+            if self._smtp is not None:
+                try:
+                    self._smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    self._smtp.close()
+                self._smtp = None
+    
+    def _get_smtp(self) -> smtplib.SMTP:
+        """認証済みSMTP接続を取得（初回のみ接続・STARTTLS・ログインを行う）"""
+        if self._smtp is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+            try:
+                server.starttls()
+                server.login(self.sender_email, self.sender_password)
+            except Exception:
+                server.close()
+                raise
+            self._smtp = server
+        return self._smtp
+    
+    def _load_config(self, config_path: str) -> Dict:
+        """YAML設定ファイルを読み込む（更新日時・サイズが変わらなければキャッシュを返す）"""
+        try:
+            config = cached_read(config_path, parse_yaml)
+            if config is not None:
+                return copy.deepcopy(config)
+        except Exception as e:
+            print(f"警告: 設定ファイルの読み込みに失敗しました: {e}")
+        return {}
+    
+    def send_quiz_completion_email(self, user_name: str, user_email: str,
+                                    course_name: str, score_percent: float,
+                                    total_score: int, max_score: int,
+                                    passed: bool) -> bool:
+        """クイズ完了時のメールを送信（ユーザーへ）"""
+        if not self.mail_enabled:
+            print("メール通知は無効に設定されています")
+            return False
+        
+        subject = f"【{course_name}】クイズ完了のお知らせ"
+        
+        html_body = self._generate_completion_email_html(
+            user_name, course_name, score_percent, total_score, max_score, passed
+        )
+        
+        return self._send_email(user_email, subject, html_body)
+    
+    def send_admin_notification(self, user_name: str, user_email: str,
+                               course_name: str, score_percent: float,
+                               total_score: int, max_score: int,
+                               passed: bool) -> bool:
+        """クイズ完了時のメールを送信（管理者へ）"""
+        if not self.mail_enabled or not self.admin_emails:
+            print("管理者メール通知は無効に設定されています")
+            return False
+        
+        subject = f"【管理者報告】{user_name}が{course_name}を完了しました"
+        
+        html_body = self._generate_admin_notification_html(
+            user_name, user_email, course_name, score_percent, total_score, max_score, passed
+        )
+        
+        # 本文は全員同じなので、管理者全員をBCCにした1通で送る
+        return self._send_email(self.sender_email, subject, html_body, bcc=self.admin_emails)
+    
+    def _generate_completion_email_html(self, user_name: str, course_name: str,
+                                        score_percent: float, total_score: int,
+                                        max_score: int, passed: bool) -> str:
+        """ユーザー向けメールのHTML生成"""
+        status = "✅ 合格" if passed else "❌ 不合格"
+        status_color = "#28a745" if passed else "#dc3545"
+        
+        html = _COMPLETION_EMAIL_TEMPLATE.substitute(
+            user_name=user_name,
+            course_name=course_name,
+            status=status,
+            status_color=status_color,
+            total_score=total_score,
+            max_score=max_score,
+            score_percent=f"{score_percent:.1f}",
+            completed_at=datetime.now().strftime('%Y年%m月%d日 %H:%M'),
+        )
+        return html
+    
+    def _generate_admin_notification_html(self, user_name: str, user_email: str,
+                                          course_name: str, score_percent: float,
+                                          total_score: int, max_score: int,
+                                          passed: bool) -> str:
+        """管理者向けメールのHTML生成"""
+        status = "合格" if passed else "不合格"
+        
+        html = _ADMIN_NOTIFICATION_TEMPLATE.substitute(
+            user_name=user_name,
+            user_email=user_email,
+            course_name=course_name,
+            status=status,
+            total_score=total_score,
+            max_score=max_score,
+            score_percent=f"{score_percent:.1f}",
+            completed_at=datetime.now().strftime('%Y年%m月%d日 %H:%M:%S'),
+        )
         return html
     
-    def _send_email(self, recipient_email: str, subject: str, html_body: str) -> bool:
-        """メール送信の実行"""
+    def _build_message(self, subject: str, html_body: str, recipient_email: str) -> MIMEMultipart:
+        """送信用のメッセージを構成"""
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        msg['From'] = self.sender_email
+        msg['To'] = recipient_email
+        
+        # HTMLを添付
+        msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+        return msg
+    
+    def _send_email(self, recipient_email: str, subject: str, html_body: str,
+                    bcc: Optional[List[str]] = None) -> bool:
+        """メール送信の実行（bccを指定した場合はBCCの宛先にのみ配送）"""
         try:
             if not self.sender_email or not self.sender_password:
                 print("エラー: メール送信の認証情報が設定されていません")
                 return False
             
-            # メッセージを構成
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = self.sender_email
-            msg['To'] = recipient_email
-            
-            # HTMLを添付
-            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+            # メッセージは1回だけバイト列に変換し、再送時もそのまま使う
+            # （BCCの宛先はヘッダーに載せず、エンベロープの宛先にのみ指定する）
+            msg = self._build_message(subject, html_body, recipient_email)
+            msg_bytes = msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+            to_addrs = list(bcc) if bcc else [recipient_email]
             
-            # メール送信
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.sender_email, self.sender_password)
-                server.send_message(msg)
+            # メール送信（接続は使い回し、切断・421応答なら1回だけ再接続）
+            with self._lock:
+                try:
+                    self._get_smtp().sendmail(self.sender_email, to_addrs, msg_bytes)
+                except smtplib.SMTPException as e:
+                    if not _session_dropped(e):
+                        raise
+                    self.close()
+                    self._get_smtp().sendmail(self.sender_email, to_addrs, msg_bytes)
             
-            print(f"✅ メール送信成功: {recipient_email}")
+            print(f"✅ メール送信成功: {', '.join(to_addrs)}")
             return True
         
         except smtplib.SMTPAuthenticationError:
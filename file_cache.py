@@ -0,0 +1,87 @@
+"""
+E-ラーニングシステム用ファイル読み込みキャッシュ
+設定・社員マスター・問題・教本ファイルの解析結果を共有する
+"""
+
+import functools
+import os
+import yaml
+from typing import Any, Callable, Dict, Optional
+
+# libyamlが利用できればCローダーで高速に解析
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+# 解析結果を保持する件数（ファイルが更新されると古い版は順に追い出される）
+_FILE_CACHE_SIZE = 100
+
+# ファイル内容（教本PDFなど数MBになるもの）を保持する件数
+# 小さな解析結果を追い出さないよう、別のキャッシュで件数を抑える
+_BYTES_CACHE_SIZE = 32
+
+
+def stat_file(path: str) -> Optional[os.stat_result]:
+    """ファイル情報を1回のstatで取得（存在しなければNone）"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=_FILE_CACHE_SIZE)
+def _parse_file(path: str, mtime_ns: int, size: int, parser: Callable[[str], Any]) -> Any:
+    """ファイルを解析（パス・更新日時・サイズ・解析関数をキーにキャッシュ）"""
+    return parser(path)
+
+
+def cached_read(path: str, parser: Callable[[str], Any]) -> Optional[Any]:
+    """
+    ファイルを解析して返す（更新日時・サイズが変わらなければキャッシュを返す）
+
+    解析結果はプロセス内で共有されるため、呼び出し側で変更しないこと。
+
+    Args:
+        path: ファイルのパス
+        parser: パスを受け取って解析結果を返す関数
+
+    Returns:
+        解析結果（ファイルが存在しなければNone）
+    """
+    path = os.path.abspath(path)
+    stat = stat_file(path)
+    if stat is None:
+        return None
+    return _parse_file(path, stat.st_mtime_ns, stat.st_size, parser)
+
+
+def parse_yaml(path: str) -> Dict:
+    """YAMLファイルを解析"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=SafeLoader) or {}
+
+
+@functools.lru_cache(maxsize=_BYTES_CACHE_SIZE)
+def _read_file_bytes(path: str, mtime_ns: int, size: int) -> bytes:
+    """ファイルの内容を読み込む（パス・更新日時・サイズをキーにキャッシュ）"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def cached_read_bytes(path: str) -> Optional[bytes]:
+    """
+    ファイルの内容をそのまま返す（更新日時・サイズが変わらなければキャッシュを返す）
+
+    Args:
+        path: ファイルのパス
+
+    Returns:
+        ファイルの内容（ファイルが存在しなければNone）
+    """
+    path = os.path.abspath(path)
+    stat = stat_file(path)
+    if stat is None:
+        return None
+    return _read_file_bytes(path, stat.st_mtime_ns, stat.st_size)
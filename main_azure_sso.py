@@ -5,18 +5,27 @@ Streamlit ベース
 """
 
 import streamlit as st
-import json
-import yaml
+import copy
+import os
+import tempfile
+import threading
 import pandas as pd
 import msal
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional
 
+# orjsonが利用できればCで高速にJSONを解析
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # 自作モジュールのインポート
 from ppt_extractor import PPTExtractor
 from database_manager import DatabaseManager
-from email_notifier import EmailNotifier
+from email_notifier import EmailNotifier, send_in_background
+from file_cache import cached_read, cached_read_bytes, parse_yaml
 
 
 # ===== ページ設定 =====
@@ -27,8 +36,8 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# ===== カスタムCSS =====
-st.markdown("""
+# ===== カスタムCSS・固定HTML（描画のたびに組み立てず、定数の文字列をそのまま渡す） =====
+_CUSTOM_CSS = """
 <style>
     .main-header {
         color: #003366;
@@ -59,17 +68,26 @@ st.markdown("""
         cursor: pointer;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+_HEADER_LOGIN = "<h1 class='main-header'>📚 E-ラーニングシステム</h1>"
+_HEADER_DASHBOARD = "<h1 class='main-header'>🏠 ホーム</h1>"
+_HEADER_RESULT = "<h1 class='main-header'>🎓 クイズ結果</h1>"
+_RESULT_PASSED = "<div class='status-passed'>✅ 合格です。おめでとうございます！</div>"
+_RESULT_FAILED = "<div class='status-failed'>❌ 不合格です。もう一度挑戦してください。</div>"
+
+# 要素は再実行のたびに描画し直す必要があるため、CSSも毎回出力する（文字列は使い回す）
+st.markdown(_CUSTOM_CSS, unsafe_allow_html=True)
 
 
 # ===== 初期化関数 =====
 
 def load_config(config_path: str = "config.yaml") -> Dict:
-    """設定ファイルを読み込む"""
+    """設定ファイルを読み込む（更新日時・サイズが変わらなければキャッシュを返す）"""
     try:
-        if Path(config_path).exists():
-            with open(config_path, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f) or {}
+        config = cached_read(config_path, parse_yaml)
+        if config is not None:
+            return copy.deepcopy(config)
         else:
             st.error(f"設定ファイルが見つかりません: {config_path}")
             return {}
@@ -78,29 +96,36 @@ def load_config(config_path: str = "config.yaml") -> Dict:
         return {}
 
 
+def _parse_employees_csv(csv_path: str) -> Dict:
+    """社員マスターCSVを解析"""
+    df = pd.read_csv(csv_path)
+    # 列単位（ベクトル演算）で正規化し、行ごとのiterrowsを避ける
+    emails = df['メールアドレス'].str.lower().str.strip()
+    employee_ids = df['社員番号'].astype(str).str.strip()
+    full_names = df['フルネーム'].fillna("").str.strip()
+    
+    # 社員番号がない場合はメールアドレスの@の前の部分を使用
+    has_employee_id = df['社員番号'].notna() & (employee_ids != "")
+    employee_ids = employee_ids.where(has_employee_id, emails.str.split('@').str[0])
+    
+    # メールアドレスをキーにしたマッピングを作成
+    return {
+        email: {
+            "employee_id": employee_id,
+            "full_name": full_name,
+            "email": email
+        }
+        for email, employee_id, full_name in zip(emails, employee_ids, full_names)
+    }
+
+
 def load_employees_csv(csv_path: str = "employees.csv") -> Dict:
     """社員マスターCSVを読み込む（メール → 社員番号のマッピング）"""
     try:
-        if Path(csv_path).exists():
-            df = pd.read_csv(csv_path)
-            # メールアドレスをキーにしたマッピングを作成
-            mapping = {}
-            for _, row in df.iterrows():
-                email = row['メールアドレス'].lower().strip()
-                employee_id = str(row['社員番号']).strip() if pd.notna(row['社員番号']) and str(row['社員番号']).strip() else None
-                full_name = row['フルネーム'].strip() if pd.notna(row['フルネーム']) else ""
-                
-                # 社員番号がない場合はメールアドレスをそのまま使用
-                if not employee_id:
-                    employee_id = email.split('@')[0]  # @の前の部分を使用
-                
-                mapping[email] = {
-                    "employee_id": employee_id,
-                    "full_name": full_name,
-                    "email": email
-                }
-            
-            return mapping
+        employees_mapping = cached_read(csv_path, _parse_employees_csv)
+        if employees_mapping is not None:
+            # 解析結果は全セッションで共有されるため、複製を返す
+            return copy.deepcopy(employees_mapping)
         else:
             st.warning(f"社員マスターが見つかりません: {csv_path}")
             return {}
@@ -109,6 +134,18 @@ def load_employees_csv(csv_path: str = "employees.csv") -> Dict:
         return {}
 
 
+@st.cache_resource
+def get_db() -> DatabaseManager:
+    """プロセス全体で共有するDatabaseManagerを取得（再実行のたびに接続を開かない）"""
+    return DatabaseManager()
+
+
+@st.cache_resource
+def get_notifier() -> EmailNotifier:
+    """プロセス全体で共有するEmailNotifierを取得（SMTP接続も使い回す）"""
+    return EmailNotifier()
+
+
 def init_session_state():
     """セッション状態を初期化"""
     if 'user_id' not in st.session_state:
@@ -131,29 +168,110 @@ def init_session_state():
         st.session_state.quiz_answers = {}
     if 'quiz_start_time' not in st.session_state:
         st.session_state.quiz_start_time = None
+    if 'azure_account_id' not in st.session_state:
+        st.session_state.azure_account_id = None
+    if 'last_submission' not in st.session_state:
+        st.session_state.last_submission = None
 
 
 # ===== Azure AD SSO認証 =====
 
-def get_azure_ad_app(config: Dict) -> msal.PublicClientApplication:
-    """Azure ADアプリケーションを初期化"""
-    azure_config = config.get('azure_ad', {})
+@st.cache_resource
+def get_token_cache_lock() -> threading.Lock:
+    """トークンキャッシュファイルへの書き込みを直列化するロック（全セッションで共有）"""
+    # スクリプトは再実行のたびに評価し直されるため、モジュール変数ではなくここで共有する
+    return threading.Lock()
+
+
+@st.cache_resource
+def get_azure_ad_app(client_id: str, authority: str,
+                     token_cache_path: str = "") -> msal.PublicClientApplication:
+    """Azure ADアプリケーションを初期化（プロセス全体で共有し、サインインのたびに作り直さない）"""
+    # token_cache_path を指定した場合のみ、トークンキャッシュをファイルに保存して再起動後も使い回す
+    # （全ユーザーのリフレッシュトークンを含むため、既定では保存しない）
+    token_cache = msal.SerializableTokenCache()
+    if token_cache_path:
+        try:
+            with open(token_cache_path, 'r', encoding='utf-8') as f:
+                token_cache.deserialize(f.read())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            # 読めない・壊れたキャッシュは空として扱い、対話的なサインインで作り直す
+            print(f"警告: トークンキャッシュを読み込めないため破棄します: {e}")
+            token_cache = msal.SerializableTokenCache()
     
     app = msal.PublicClientApplication(
-        client_id=azure_config['client_id'],
-        authority=azure_config['authority']
+        client_id=client_id,
+        authority=authority,
+        token_cache=token_cache
     )
     return app
 
 
-def authenticate_with_azure_ad(config: Dict, employees_mapping: Dict) -> Optional[Dict]:
-    """Azure ADでユーザーを認証"""
+def save_token_cache(app: msal.PublicClientApplication, token_cache_path: str):
+    """トークンキャッシュが更新されていればファイルに書き出す"""
+    token_cache = app.token_cache
+    if not token_cache_path or not token_cache.has_state_changed:
+        return
+    
+    # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+    with get_token_cache_lock():
+        # mkstempは所有者のみ読み書きできる（0600）一意なファイルを作成する
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(token_cache_path) or ".",
+                                        prefix=".msal_token_cache.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(token_cache.serialize())
+            os.replace(tmp_path, token_cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        token_cache.has_state_changed = False
+
+
+def _find_account(app: msal.PublicClientApplication, home_account_id: Optional[str]) -> Optional[Dict]:
+    """トークンキャッシュから指定したアカウントを探す（見つからなければNone）"""
+    if not home_account_id:
+        return None
+    for account in app.get_accounts():
+        if account.get("home_account_id") == home_account_id:
+            return account
+    return None
+
+
+def authenticate_with_azure_ad(config: Dict, employees_mapping: Dict,
+                               home_account_id: Optional[str] = None) -> Optional[Dict]:
+    """
+    Azure ADでユーザーを認証
+    
+    Args:
+        home_account_id: このセッションで以前に対話的にサインインしたアカウント
+            （トークンキャッシュは全セッションで共有されるため、他のアカウントは使わない）
+    """
     azure_config = config.get('azure_ad', {})
-    app = get_azure_ad_app(config)
+    token_cache_path = azure_config.get('token_cache_path', "")
     
     try:
-        # 対話的にトークンを取得
-        result = app.acquire_token_interactive(scopes=azure_config['scopes'])
+        app = get_azure_ad_app(
+            azure_config['client_id'],
+            azure_config['authority'],
+            token_cache_path
+        )
+        
+        # このセッションのアカウントのトークンがキャッシュにあればブラウザを開かずに取得
+        result = None
+        account = _find_account(app, home_account_id)
+        if account:
+            result = app.acquire_token_silent(azure_config['scopes'], account=account)
+        
+        # 取得できなければ対話的にトークンを取得し、サインインしたアカウントを記録
+        if not result:
+            result = app.acquire_token_interactive(scopes=azure_config['scopes'])
+            username = result.get("id_token_claims", {}).get("preferred_username")
+            accounts = app.get_accounts(username=username) if username else []
+            account = accounts[0] if accounts else None
+        save_token_cache(app, token_cache_path)
         
         if "access_token" in result:
             # ユーザー情報を取得
@@ -173,7 +291,8 @@ def authenticate_with_azure_ad(config: Dict, employees_mapping: Dict) -> Optiona
                     "email": email,
                     "full_name": employee_info['full_name'],
                     "employee_id": employee_info['employee_id'],
-                    "azure_id": user_info['id']
+                    "azure_id": user_info['id'],
+                    "home_account_id": account.get("home_account_id") if account else None
                 }
             else:
                 return {
@@ -194,12 +313,45 @@ def authenticate_with_azure_ad(config: Dict, employees_mapping: Dict) -> Optiona
         }
 
 
+def sign_out_azure_ad(config: Dict, home_account_id: Optional[str]):
+    """このセッションのアカウントを共有トークンキャッシュから削除"""
+    if not home_account_id:
+        return
+    azure_config = config.get('azure_ad', {})
+    token_cache_path = azure_config.get('token_cache_path', "")
+    try:
+        app = get_azure_ad_app(
+            azure_config['client_id'],
+            azure_config['authority'],
+            token_cache_path
+        )
+        account = _find_account(app, home_account_id)
+        if account:
+            app.remove_account(account)
+            save_token_cache(app, token_cache_path)
+    except Exception as e:
+        st.warning(f"サインアウト処理でエラーが発生しました: {e}")
+
+
+def _parse_questions(questions_file: str) -> List[Dict]:
+    """問題ファイルを解析"""
+    with open(questions_file, 'rb') as f:
+        questions = json_loads(f.read())
+    
+    # 採点用に正解の集合を読み込み時に一度だけ作っておく
+    for q in questions:
+        q['_correct_set'] = frozenset(q['correct_answers'])
+    return questions
+
+
 def load_questions(questions_file: str = "questions.json") -> List[Dict]:
-    """問題ファイルを読み込む"""
+    """問題ファイルを読み込む（更新されるまで解析結果を共有）"""
     try:
-        if Path(questions_file).exists():
-            with open(questions_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        questions = cached_read(questions_file, _parse_questions)
+        if questions is not None:
+            # 解析結果は全セッションで共有されるため、複製を返す
+            # （あるセッションでの変更が他のセッションの問題に及ばないようにする）
+            return copy.deepcopy(questions)
         else:
             st.warning(f"問題ファイルが見つかりません: {questions_file}")
             return []
@@ -212,7 +364,7 @@ def load_questions(questions_file: str = "questions.json") -> List[Dict]:
 
 def show_login_page():
     """Azure AD SSO ログイン画面"""
-    st.markdown("<h1 class='main-header'>📚 E-ラーニングシステム</h1>", unsafe_allow_html=True)
+    st.markdown(_HEADER_LOGIN, unsafe_allow_html=True)
     
     col1, col2, col3 = st.columns([1, 1.5, 1])
     
@@ -224,34 +376,32 @@ def show_login_page():
         employees_mapping = load_employees_csv()
         
         if st.button("🔵 Microsoftでサインイン", use_container_width=True, type="primary"):
-            result = authenticate_with_azure_ad(config, employees_mapping)
+            result = authenticate_with_azure_ad(config, employees_mapping,
+                                                st.session_state.azure_account_id)
             
             if result["status"] == "success":
-                # セッションに保存
-                st.session_state.email = result["email"]
-                st.session_state.full_name = result["full_name"]
-                st.session_state.employee_id = result["employee_id"]
-                st.session_state.username = result["employee_id"]
-                st.session_state.role = "student"  # デフォルトロール
-                st.session_state.current_page = "dashboard"
-                
-                # データベースにユーザーを登録
-                db = DatabaseManager()
-                user_id = db.authenticate_user(result["employee_id"], "azure_sso")
-                if not user_id:
-                    # ユーザーが存在しない場合は作成
-                    db.add_user(
-                        result["employee_id"],
-                        "azure_sso_placeholder",
-                        result["email"],
-                        result["full_name"],
-                        "student"
-                    )
-                    user_id = db.authenticate_user(result["employee_id"], "azure_sso_placeholder")
-                
-                st.session_state.user_id = user_id
-                st.success("✅ ログインしました")
-                st.rerun()
+                # データベースにユーザーを登録（未登録なら作成）し、ユーザーIDを取得
+                db = get_db()
+                user_id = db.upsert_sso_user(
+                    result["employee_id"],
+                    result["email"],
+                    result["full_name"],
+                    "student"
+                )
+                if user_id:
+                    # セッションに保存
+                    st.session_state.email = result["email"]
+                    st.session_state.full_name = result["full_name"]
+                    st.session_state.employee_id = result["employee_id"]
+                    st.session_state.username = result["employee_id"]
+                    st.session_state.role = "student"  # デフォルトロール
+                    st.session_state.current_page = "dashboard"
+                    st.session_state.user_id = user_id
+                    st.session_state.azure_account_id = result["home_account_id"]
+                    st.success("✅ ログインしました")
+                    st.rerun()
+                else:
+                    st.error("❌ ログイン失敗\n\nこのアカウントは現在利用できません。管理者に連絡してください。")
             else:
                 st.error(f"❌ ログイン失敗\n\n{result['message']}")
         
@@ -268,10 +418,10 @@ def show_login_page():
 
 def show_dashboard():
     """ユーザーダッシュボード"""
-    db = DatabaseManager()
+    db = get_db()
     config = load_config()
     
-    st.markdown(f"<h1 class='main-header'>🏠 ホーム</h1>", unsafe_allow_html=True)
+    st.markdown(_HEADER_DASHBOARD, unsafe_allow_html=True)
     
     # ユーザー情報を表示
     col1, col2, col3 = st.columns(3)
@@ -329,7 +479,7 @@ def show_dashboard():
 
 def show_learning_page():
     """学習画面（教本表示）"""
-    db = DatabaseManager()
+    db = get_db()
     config = load_config()
     
     st.markdown(f"<h1 class='main-header'>📘 {st.session_state.current_course_name}</h1>", 
@@ -344,20 +494,20 @@ def show_learning_page():
     
     # PDFファイルを表示
     pdf_path = st.session_state.current_course_pdf
+    # ファイルの内容は更新されるまでキャッシュを使う（bytesは不変のためコピーしない）
+    pdf_bytes = cached_read_bytes(pdf_path) if pdf_path else None
     
-    if pdf_path and Path(pdf_path).exists():
+    if pdf_bytes is not None:
         st.markdown("## 📄 教本")
         st.info("PDFを確認してから、クイズに進んでください")
         
         # PDFを埋め込み表示
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_bytes = pdf_file.read()
-            st.download_button(
-                label="PDFをダウンロード",
-                data=pdf_bytes,
-                file_name=Path(pdf_path).name,
-                mime="application/pdf"
-            )
+        st.download_button(
+            label="PDFをダウンロード",
+            data=pdf_bytes,
+            file_name=Path(pdf_path).name,
+            mime="application/pdf"
+        )
     else:
         st.warning(f"教本ファイルが見つかりません: {pdf_path}")
     
@@ -379,7 +529,7 @@ def show_learning_page():
 
 def show_quiz_page():
     """クイズ実施画面"""
-    db = DatabaseManager()
+    db = get_db()
     config = load_config()
     questions = load_questions()
     
@@ -444,61 +594,66 @@ def show_quiz_page():
 
 def submit_quiz(questions: List[Dict], db: DatabaseManager, config: Dict):
     """クイズを採点して結果を表示"""
+    # 再実行による二重送信（結果の重複保存・メールの重複送信）を防ぐ
+    # （同じユーザー・コース・開始時刻の回答は1回だけ保存・通知する）
+    submission_key = (
+        st.session_state.user_id,
+        st.session_state.current_course_id,
+        st.session_state.quiz_start_time.isoformat()
+    )
+    if st.session_state.last_submission == submission_key:
+        st.session_state.current_page = "result"
+        st.rerun()
+    
     # 採点ロジック
     total_score = 0
     max_score = 0
     correct_count = 0
+    results = []
+    points_per_question = config['quiz'].get('points_per_question', 20)
     
     for q in questions:
-        max_score += config['quiz'].get('points_per_question', 20)
+        max_score += points_per_question
         
         selected = st.session_state.quiz_answers.get(q['id'], [])
-        correct_answers = q['correct_answers']
         
-        is_correct = set(selected) == set(correct_answers)
+        is_correct = frozenset(selected) == q['_correct_set']
         
         if is_correct:
-            total_score += config['quiz'].get('points_per_question', 20)
+            total_score += points_per_question
             correct_count += 1
         
-        # データベースに保存
-        db.save_quiz_result(
-            st.session_state.user_id,
-            st.session_state.current_course_id,
-            q['id'],
-            selected,
-            is_correct,
-            config['quiz'].get('points_per_question', 20) if is_correct else 0
-        )
+        # 回答結果はまとめて保存する
+        results.append({
+            "question_id": q['id'],
+            "selected_answers": selected,
+            "is_correct": is_correct,
+            "score_earned": points_per_question if is_correct else 0
+        })
     
     # 成績を計算
     score_percent = (total_score / max_score * 100) if max_score > 0 else 0
     passed = score_percent >= st.session_state.passing_score
     
-    # 成績を保存
-    db.save_course_score(
+    # 回答結果と成績を1トランザクションで保存
+    saved = db.save_quiz_submission(
         st.session_state.user_id,
         st.session_state.current_course_id,
+        results,
         total_score,
         max_score,
         st.session_state.passing_score
     )
+    if not saved:
+        # 保存できなかった回答は提出済みとして扱わず、通知も送らない（再提出できるようにする）
+        st.error("❌ 回答の保存に失敗しました。時間をおいて再度提出してください。")
+        return
+    st.session_state.last_submission = submission_key
     
-    # 通知を送信
-    notifier = EmailNotifier()
-    
-    if st.session_state.email:
-        notifier.send_quiz_completion_email(
-            st.session_state.full_name,
-            st.session_state.email,
-            st.session_state.current_course_name,
-            score_percent,
-            total_score,
-            max_score,
-            passed
-        )
-    
-    notifier.send_admin_notification(
+    # 通知はバックグラウンドで送信し、結果画面をすぐに表示する
+    send_in_background(
+        send_quiz_notifications,
+        get_notifier(),
         st.session_state.full_name,
         st.session_state.email,
         st.session_state.current_course_name,
@@ -519,11 +674,38 @@ def submit_quiz(questions: List[Dict], db: DatabaseManager, config: Dict):
     st.rerun()
 
 
+def send_quiz_notifications(notifier: EmailNotifier, full_name: str, email: Optional[str],
+                            course_name: str, score_percent: float, total_score: int,
+                            max_score: int, passed: bool):
+    """クイズ完了のメールをユーザー・管理者へ送信（ワーカースレッドで実行）"""
+    # 共有のnotifierがSMTP接続を保持しているため、送信後も接続は閉じない
+    if email:
+        notifier.send_quiz_completion_email(
+            full_name,
+            email,
+            course_name,
+            score_percent,
+            total_score,
+            max_score,
+            passed
+        )
+    
+    notifier.send_admin_notification(
+        full_name,
+        email,
+        course_name,
+        score_percent,
+        total_score,
+        max_score,
+        passed
+    )
+
+
 # ===== 結果表示画面 =====
 
 def show_result_page():
     """クイズ結果表示"""
-    st.markdown("<h1 class='main-header'>🎓 クイズ結果</h1>", unsafe_allow_html=True)
+    st.markdown(_HEADER_RESULT, unsafe_allow_html=True)
     
     # 結果サマリー
     col1, col2, col3 = st.columns(3)
@@ -541,11 +723,9 @@ def show_result_page():
     
     # 判定
     if st.session_state.result_passed:
-        st.markdown(f"<div class='status-passed'>✅ 合格です。おめでとうございます！</div>", 
-                   unsafe_allow_html=True)
+        st.markdown(_RESULT_PASSED, unsafe_allow_html=True)
     else:
-        st.markdown(f"<div class='status-failed'>❌ 不合格です。もう一度挑戦してください。</div>", 
-                   unsafe_allow_html=True)
+        st.markdown(_RESULT_FAILED, unsafe_allow_html=True)
     
     st.divider()
     
@@ -578,6 +758,8 @@ def main():
         
         with col3:
             if st.button("ログアウト"):
+                sign_out_azure_ad(load_config(), st.session_state.azure_account_id)
+                st.session_state.azure_account_id = None
                 st.session_state.user_id = None
                 st.session_state.username = None
                 st.session_state.email = None
@@ -1,13 +1,212 @@
 """
 PPTXファイルから問題を自動抽出するモジュール
 スライドの構造に基づいて問題文・選択肢・正解を抽出
+
+mypyc でそのままコンパイルできる（`mypyc ppt_extractor.py` で生成した拡張モジュールが優先して読み込まれる）
 """
 
+import functools
 import json
+import os
+import posixpath
 import re
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from pathlib import Path
-from pptx import Presentation
-from typing import List, Dict, Any
+from typing import Iterable, Iterator, List, Dict, Any, Optional, Tuple
+
+from xml.etree.ElementTree import iterparse as _etree_iterparse
+
+from file_cache import stat_file
+
+# orjson・lxmlが利用できればCで高速に処理（なければ標準ライブラリ）
+# （関数の条件付き定義は mypyc でコンパイルできないため、モジュールの有無で分岐する）
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    from lxml import etree as _lxml_etree  # type: ignore[import-untyped]
+except ImportError:
+    _lxml_etree = None
+
+
+def _json_dump_bytes(obj: Any) -> bytes:
+    """JSONを2スペースのインデント・UTF-8のバイト列に変換"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _iterparse_tag(source: BytesIO, tag: str) -> Iterator[Any]:
+    """XMLを逐次解析し、指定したタグの要素を閉じた順に返す"""
+    if _lxml_etree is not None:
+        # lxmlはタグを絞り込んで解析できる
+        for _, elem in _lxml_etree.iterparse(source, events=('end',), tag=tag):
+            yield elem
+    else:
+        for _, elem in _etree_iterparse(source, events=('end',)):
+            if elem.tag == tag:
+                yield elem
+
+
+# ===== 問題文・選択肢の検出パターン（起動時に一度だけコンパイル） =====
+# スライドの全行を1回の走査で分類する（MULTILINEで各行の先頭から照合）
+#   問題文: 「問題」か「N.」で始まる行（問題番号を除いた本文を qtext に取得）
+#   選択肢: 「A.～E.」で始まる行（末尾の○×✓✕は ctext に含めたまま取得）
+# 空白は改行をまたがないよう [^\S\n] で表す
+_RE_SLIDE = re.compile(r'''
+    ^(?:
+        (?=問題|\d+\.)(?:問題\d+[^\S\n]*)?(?:\d+\.[^\S\n]*)?(?P<qtext>.*)
+        |
+        (?P<letter>[A-E])\.[^\S\n]*(?P<ctext>.+)
+    )$
+''', re.VERBOSE | re.MULTILINE)
+
+# 選択肢末尾の正誤記号 → 正解かどうか（○・✓が正解、1回の参照で記号判定と正誤を兼ねる）
+_MARK_TO_BOOL = {"○": True, "✓": True, "×": False, "✕": False}
+
+# ===== PPTX（OOXML）の構造 =====
+_NS_A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+_NS_P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+_NS_R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_NS_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+_PRESENTATION_XML = 'ppt/presentation.xml'
+_PRESENTATION_RELS = 'ppt/_rels/presentation.xml.rels'
+
+# 図形のテキスト枠・段落と、段落内で文字列になる要素（改行は python-pptx と同じく '\v'）
+_TAG_TXBODY = f'{_NS_P}txBody'
+_TAG_PARAGRAPH = f'{_NS_A}p'
+_TAG_RUN = f'{_NS_A}r'
+_TAG_FIELD = f'{_NS_A}fld'
+_TAG_BREAK = f'{_NS_A}br'
+_TAG_TEXT = f'{_NS_A}t'
+
+# この枚数以上のスライドはプロセスプールで並列に解析
+# （1枚あたりの解析は数十マイクロ秒のため、少ない枚数ではプロセス起動のコストの方が大きい）
+_PARALLEL_MIN_SLIDES = 1000
+
+# 展開したスライドXMLを保持するファイル数
+# （デッキ全体のXMLは大きいため、設定などの小さな解析結果とは別のキャッシュで件数を抑える）
+_SLIDE_XML_CACHE_SIZE = 8
+
+
+def _read_slide_xmls(pptx_path: str) -> List[bytes]:
+    """PPTXを1回だけ展開し、表示順のスライドXMLを返す"""
+    with zipfile.ZipFile(pptx_path) as zf:
+        # スライドの表示順は presentation.xml の sldIdLst（ファイル名の番号とは限らない）
+        rels = {}
+        for rel in _iterparse_tag(BytesIO(zf.read(_PRESENTATION_RELS)), f'{_NS_REL}Relationship'):
+            rels[rel.get('Id')] = rel.get('Target')
+        
+        slide_names = []
+        for sld_id in _iterparse_tag(BytesIO(zf.read(_PRESENTATION_XML)), f'{_NS_P}sldId'):
+            target = rels[sld_id.get(f'{_NS_R}id')]
+            # 相対パスは ppt/ からの位置、先頭が / ならパッケージルートからの位置
+            if target.startswith('/'):
+                slide_names.append(target[1:])
+            else:
+                slide_names.append(posixpath.normpath(posixpath.join('ppt', target)))
+        return [zf.read(name) for name in slide_names]
+
+
+@functools.lru_cache(maxsize=_SLIDE_XML_CACHE_SIZE)
+def _read_slide_xmls_cached(pptx_path: str, mtime_ns: int, size: int) -> List[bytes]:
+    """スライドXMLを展開（パス・更新日時・サイズをキーにキャッシュ）"""
+    return _read_slide_xmls(pptx_path)
+
+
+def _paragraph_text(paragraph) -> str:
+    """段落のテキスト（テキストラン・フィールド・改行）を連結"""
+    parts = []
+    for child in paragraph:
+        if child.tag == _TAG_RUN or child.tag == _TAG_FIELD:
+            t = child.find(_TAG_TEXT)
+            if t is not None and t.text:
+                parts.append(t.text)
+        elif child.tag == _TAG_BREAK:
+            parts.append('\v')
+    return ''.join(parts)
+
+
+def iter_slide_xml_lines(slide_xml: bytes) -> Iterator[str]:
+    """
+    スライドXMLから図形のテキストを1行ずつ返す（グループ内の図形も文書順に含む）
+    各行は前後の空白を除き、空行は返さない
+    """
+    # テキスト枠を持つ図形（p:sp の p:txBody）だけを対象にし、画像・表・グラフは飛ばす
+    for txbody in _iterparse_tag(BytesIO(slide_xml), _TAG_TXBODY):
+        # 段落ごとに行として返す（図形全体の文字列を結合・分割し直さない）
+        for paragraph in txbody.iterfind(_TAG_PARAGRAPH):
+            for line in _paragraph_text(paragraph).split('\n'):
+                line = line.strip()
+                if line:
+                    yield line
+        txbody.clear()
+
+
+def parse_question_lines(lines: Iterable[str], question_num: int) -> Optional[Dict[str, Any]]:
+    """
+    テキストの各行から問題データを抽出
+    形式: 「問題N 問題文」+ 「A.～E. 選択肢」で○✕記載
+    
+    Args:
+        lines: 前後の空白を除いた空でない行（iter_slide_xml_lines の出力）
+        question_num: 問題番号
+    """
+    question_text = ""
+    choices: List[Dict[str, Any]] = []
+    
+    # 問題文と選択肢を分離（行ごとに照合せず、結合したテキストを1回で走査）
+    for match in _RE_SLIDE.finditer('\n'.join(lines)):
+        # 問題文の検出（「問題」か「N.」で始まる）
+        qtext = match.group('qtext')
+        if qtext is not None:
+            # 問題番号を除いた問題文
+            question_text = qtext
+        else:
+            # 選択肢の検出（A. B. C. D. E.）
+            choice_letter = match.group('letter')
+            choice_text = match.group('ctext')
+            
+            # 末尾の1文字で正誤記号を判定（記号だけの選択肢は本文として扱う）
+            is_correct = _MARK_TO_BOOL.get(choice_text[-1])
+            if is_correct is not None and len(choice_text) > 1:
+                choice_text = choice_text[:-1]
+            else:
+                is_correct = False
+            choice_text = choice_text.strip()
+            
+            choices.append({
+                "letter": choice_letter,
+                "text": choice_text,
+                "is_correct": is_correct
+            })
+    
+    if not question_text or not choices:
+        return None
+    
+    # 正解は選択肢から最後に一度だけ導出
+    correct_answers = [c["letter"] for c in choices if c["is_correct"]]
+    
+    return {
+        "id": question_num,
+        "question": question_text,
+        "choices": choices,
+        "correct_answers": correct_answers,
+        "multiple_choice": len(correct_answers) > 1
+    }
+
+
+def _parse_slide(slide: Tuple[int, bytes]) -> Optional[Dict[str, Any]]:
+    """スライド1枚（番号・XML）から問題データを抽出（ワーカープロセスで実行）"""
+    slide_idx, slide_xml = slide
+    # 空のスライドは問題文・選択肢がないため None になる
+    return parse_question_lines(iter_slide_xml_lines(slide_xml), slide_idx)
 
 
 class PPTExtractor:
@@ -19,107 +218,64 @@ class PPTExtractor:
             pptx_path: PPTXファイルのパス
         """
         self.pptx_path = pptx_path
-        self.presentation = None
-        self.questions = []
+        self.slide_xmls: List[bytes] = []
+        self.questions: List[Dict[str, Any]] = []
         
     def load_presentation(self) -> bool:
-        """PPTXファイルを読み込む"""
+        """PPTXファイルを読み込む（スライドのXMLだけを取り出し、オブジェクトモデルは構築しない）"""
         try:
-            self.presentation = Presentation(self.pptx_path)
+            # 同じファイルは更新されるまで展開結果を使い回す
+            pptx_path = os.path.abspath(self.pptx_path)
+            stat = stat_file(pptx_path)
+            if stat is None:
+                raise FileNotFoundError(f"ファイルが見つかりません: {self.pptx_path}")
+            self.slide_xmls = _read_slide_xmls_cached(pptx_path, stat.st_mtime_ns, stat.st_size)
             return True
         except Exception as e:
             print(f"エラー: PPTXファイルの読み込みに失敗しました: {e}")
             return False
     
-    def extract_text_from_slide(self, slide) -> str:
+    def iter_slide_lines(self, slide_xml: bytes) -> Iterator[str]:
+        """スライドのテキストを1行ずつ返す（図形ごとに分割し、結合した文字列は作らない）"""
+        return iter_slide_xml_lines(slide_xml)
+    
+    def extract_text_from_slide(self, slide_xml: bytes) -> str:
         """スライドからすべてのテキストを抽出"""
-        text = []
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                if shape.text.strip():
-                    text.append(shape.text.strip())
-        return "\n".join(text)
+        return "\n".join(self.iter_slide_lines(slide_xml))
     
     def extract_questions(self) -> List[Dict[str, Any]]:
         """
         PPTXから問題を抽出
         構造：スライド2以降が問題（スライド1はタイトル）
         """
-        if not self.presentation:
+        if not self.slide_xmls:
             return []
         
-        self.questions = []
-        
         # スライド2以降を処理（スライド1はタイトルスライド）
-        for slide_idx, slide in enumerate(self.presentation.slides[1:], start=1):
-            text = self.extract_text_from_slide(slide)
-            if not text.strip():
-                continue
-            
-            question_data = self._parse_question_text(text, slide_idx)
-            if question_data:
-                self.questions.append(question_data)
+        slides = list(enumerate(self.slide_xmls[1:], start=1))
+        
+        # スライドごとに独立しているため、枚数が多ければ複数プロセスで並列に解析
+        # （結果はスライド順に返る）
+        results: Iterable[Optional[Dict[str, Any]]]
+        workers = os.cpu_count() or 1
+        if workers > 1 and len(slides) >= _PARALLEL_MIN_SLIDES:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_parse_slide, slides,
+                                            chunksize=max(1, len(slides) // (workers * 4))))
+        else:
+            results = map(_parse_slide, slides)
         
+        self.questions = [question_data for question_data in results if question_data]
         return self.questions
     
-    def _parse_question_text(self, text: str, question_num: int) -> Dict[str, Any]:
-        """
-        テキストから問題データを抽出
-        形式: 「問題N 問題文」+ 「A.～E. 選択肢」で○✕記載
-        """
-        lines = text.split('\n')
-        
-        question_text = ""
-        choices = []
-        correct_answers = []
-        
-        # 問題文と選択肢を分離
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # 問題文の検出（「問題」で始まるか、数字で始まる）
-            if line.startswith('問題') or (len(line) > 0 and line[0].isdigit() and '.' in line):
-                # 問題番号を削除して問題文を取得
-                question_text = re.sub(r'^問題\d+\s*', '', line)
-                question_text = re.sub(r'^\d+\.\s*', '', question_text)
-            
-            # 選択肢の検出（A. B. C. D. E.）
-            match = re.match(r'^([A-E])\.\s*(.+?)(\s*[○×✓✕])?$', line)
-            if match:
-                choice_letter = match.group(1)
-                choice_text = match.group(2).strip()
-                correct_mark = match.group(3).strip() if match.group(3) else ""
-                
-                # ○またはTrueで正解判定
-                is_correct = "○" in correct_mark or "✓" in correct_mark
-                
-                choices.append({
-                    "letter": choice_letter,
-                    "text": choice_text,
-                    "is_correct": is_correct
-                })
-                
-                if is_correct:
-                    correct_answers.append(choice_letter)
-        
-        if not question_text or not choices:
-            return None
-        
-        return {
-            "id": question_num,
-            "question": question_text,
-            "choices": choices,
-            "correct_answers": correct_answers,
-            "multiple_choice": len(correct_answers) > 1
-        }
+    def _parse_question_text(self, lines: Iterable[str], question_num: int) -> Optional[Dict[str, Any]]:
+        """テキストの各行から問題データを抽出"""
+        return parse_question_lines(lines, question_num)
     
     def save_questions_to_json(self, output_path: str) -> bool:
         """問題をJSONファイルに保存"""
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(self.questions, f, ensure_ascii=False, indent=2)
+            Path(output_path).write_bytes(_json_dump_bytes(self.questions))
             print(f"✅ 問題を保存しました: {output_path}")
             print(f"   {len(self.questions)}問を抽出しました")
             return True
@@ -128,21 +284,25 @@ class PPTExtractor:
             return False
     
     def display_questions(self):
-        """抽出された問題を表示（デバッグ用）"""
+        """抽出された問題を表示（デバッグ用、全体を1回の書き込みで出力）"""
+        out = []
         for q in self.questions:
-            print(f"\n{'='*60}")
-            print(f"問題 {q['id']}: {q['question']}")
-            print(f"複数選択: {q['multiple_choice']}")
+            out.append(f"\n{'='*60}")
+            out.append(f"問題 {q['id']}: {q['question']}")
+            out.append(f"複数選択: {q['multiple_choice']}")
             for choice in q['choices']:
                 mark = "✅" if choice['is_correct'] else "  "
-                print(f"  {mark} {choice['letter']}. {choice['text']}")
-            print(f"正解: {', '.join(q['correct_answers'])}")
+                out.append(f"  {mark} {choice['letter']}. {choice['text']}")
+            out.append(f"正解: {', '.join(q['correct_answers'])}")
+        
+        if out:
+            out.append("")
+            sys.stdout.write("\n".join(out))
+            sys.stdout.flush()
 
 
 def main():
     """メイン処理（スタンドアロン実行用）"""
-    import sys
-    
     if len(sys.argv) < 2:
         print("使用方法: python ppt_extractor.py <pptxファイルパス> [出力パス]")
         sys.exit(1)